@@ -4,17 +4,31 @@ import pandas as pd
 import numpy as np
 
 from datetime import datetime
-from scipy.stats import beta
-from libs.calc_prob import calc_prob_between
+import libs.prob_cache as prob_cache
+import libs.monte_carlo as monte_carlo
+import libs.bootstrap as bootstrap
+import libs.render as render
+import libs.instrument as instrument
 
-import matplotlib.pyplot as plt
-import seaborn as sns
-generated_full_palette = sns.color_palette([ "#003f5c", "#2f4b7c", "#665191", "#a05195", "#d45087", "#f95d6a", "#ff7c43", "#ffa600", ], 8)
-generated_palette = sns.color_palette(["#003f5c", "#a05195", "#ffa600"], 3)
-generated_small_palette = sns.color_palette(["#003f5c", "#ffa600"], 2)
-sns.set_theme(style="darkgrid")
+generated_full_palette = [ "#003f5c", "#2f4b7c", "#665191", "#a05195", "#d45087", "#f95d6a", "#ff7c43", "#ffa600", ]
+generated_palette = ["#003f5c", "#a05195", "#ffa600"]
+generated_small_palette = ["#003f5c", "#ffa600"]
 
-def bayes(data, impressions="Sessions", goal="Transactions", control="Control", variant="Variation 1", name=None):
+# `engine` is either "exact" (closed-form series) or "monte_carlo" (posterior sampling),
+# the latter also returns probability to be best across all variants, expected loss and a credible interval on Impact.
+# "bootstrap" resamples the `unit`s of `data` (e.g. "user_pseudo_id", defaulting to "event_date") instead, for continuous
+# metrics such as revenue. With fewer than `bootstrap.MIN_UNITS` units per variant, Chance of being best is NaN.
+@instrument.timed()
+def bayes(data, impressions="Sessions", goal="Transactions", control="Control", variant="Variation 1", name=None, engine="exact", draws=monte_carlo.DEFAULT_DRAWS, seed=monte_carlo.DEFAULT_SEED, unit=None):
+    if engine == "bootstrap":
+        if unit == None and bootstrap.DEFAULT_UNIT in data.columns:
+            unit = bootstrap.DEFAULT_UNIT
+        if unit == None:
+            raise ValueError(f"The bootstrap engine needs a `unit` column to resample, and there's no '{bootstrap.DEFAULT_UNIT}' column")
+        result = bootstrap.compare(data, unit, impressions=impressions, goal=goal, control=control, variant=variant, name=name, seed=seed)
+        if result != None:
+            return result
+    control_name = control
     control = data[data["optimisation_variant"] == control].copy()
     test = data[data["optimisation_variant"] == variant].copy()
     if control.shape[0] == 0 or control[impressions].sum() == 0 or control[goal].sum() == 0:
@@ -28,11 +42,9 @@ def bayes(data, impressions="Sessions", goal="Transactions", control="Control",
     convs_ctrl = control[goal].mean()
     imps_test = test[impressions].mean()
     convs_test = test[goal].mean()
-    # here we create the Beta functions for the two sets
+    # here we create the Beta parameters for the two sets
     a_C, b_C = convs_ctrl+1, imps_ctrl-convs_ctrl+1
-    beta_C = beta(a_C, b_C)
     a_T, b_T = convs_test+1, imps_test-convs_test+1
-    beta_T = beta(a_T, b_T)
     #calculating the lift
     cr_test = convs_test.mean() / imps_test.mean()
     cr_ctrl = convs_ctrl.mean() / imps_ctrl.mean()
@@ -40,13 +52,152 @@ def bayes(data, impressions="Sessions", goal="Transactions", control="Control",
         lift = 0
     else:
         lift=(cr_test-cr_ctrl)/cr_ctrl
-    #calculating the probability for Test to be better than Control
-    prob=calc_prob_between(beta_T, beta_C)
-    # prob=calc_prob_between(beta_T, beta_C)
     if name == None:
         name = goal
+    # The Beta comparison doesn't hold for continuous metrics, so a bootstrap that couldn't run only reports the lift
+    if engine == "bootstrap":
+        return {"variant": variant, "metric": name, "Impact": lift*100, "Chance of being best": np.nan }
+    if engine == "monte_carlo":
+        means = data.groupby("optimisation_variant")[[impressions, goal]].mean()
+        order = [control_name] + [v for v in means.index if v != control_name]
+        sim = monte_carlo.simulate(means.loc[order, goal].to_numpy(), means.loc[order, impressions].to_numpy(), control=0, draws=draws, seed=seed)
+        column = order.index(variant)
+        result = {"variant": variant, "metric": name, "Impact": lift*100 }
+        for stat in sim:
+            result[stat] = sim[stat][0, column]*100
+        return result
+    #calculating the probability for Test to be better than Control
+    prob=prob_cache.cached_g(a_T, b_T, a_C, b_C)
+    # prob=calc_prob_between(beta_T, beta_C)
     return {"variant": variant, "metric": name, "Impact": lift*100, "Chance of being best": prob*100 }
 
+# Scores every variant row of a `summarise_test` summary against the control for every metric in one pass.
+# Returns one row per (summary row, metric) indexed like `summary`, with the same keys as `bayes()`.
+# With `dimensions`, the summary is partitioned by those columns and each row is compared to its own partition's control.
+@instrument.timed()
+def bayes_batch(summary, metrics, control_name="Control", dimensions=None):
+    metrics = [metric for metric in metrics if metric["previous_step"] != None]
+    if len(metrics) == 0:
+        return pd.DataFrame(columns=["variant", "metric", "Impact", "Chance of being best"])
+    variants = summary["optimisation_variant"].to_numpy()
+    is_control = variants == control_name
+    convs_test = np.column_stack([summary[metric["name"]].to_numpy(dtype=float) for metric in metrics])
+    imps_test = np.column_stack([summary[metric["previous_step"]].to_numpy(dtype=float) for metric in metrics])
+
+    if dimensions:
+        # Control totals per partition, mapped back onto every row of that partition
+        partition = summary.groupby(dimensions, sort=False, dropna=False).ngroup().to_numpy()
+        partitions = partition.max() + 1
+        control_rows = np.bincount(partition[is_control], minlength=partitions)
+        convs_ctrl = np.column_stack([np.bincount(partition[is_control], weights=column, minlength=partitions) for column in convs_test[is_control].T])[partition]
+        imps_ctrl = np.column_stack([np.bincount(partition[is_control], weights=column, minlength=partitions) for column in imps_test[is_control].T])[partition]
+        has_control = (control_rows[partition, None] > 0) & (convs_ctrl != 0) & (imps_ctrl != 0)
+    # Otherwise the rows of each variant, control included, are pooled the same way `bayes()` pools them
+    elif is_control.any():
+        codes = pd.factorize(variants)[0]
+        counts = np.bincount(codes)[:, None]
+        convs_test = (np.column_stack([np.bincount(codes, weights=column) for column in convs_test.T]) / counts)[codes]
+        imps_test = (np.column_stack([np.bincount(codes, weights=column) for column in imps_test.T]) / counts)[codes]
+        convs_ctrl = np.broadcast_to(convs_test[is_control].mean(axis=0), convs_test.shape)
+        imps_ctrl = np.broadcast_to(imps_test[is_control].mean(axis=0), imps_test.shape)
+        has_control = np.broadcast_to((convs_test[is_control].sum(axis=0) != 0) & (imps_test[is_control].sum(axis=0) != 0), convs_test.shape)
+    else:
+        convs_ctrl = imps_ctrl = np.zeros(convs_test.shape)
+        has_control = np.zeros(convs_test.shape, dtype=bool)
+    valid = has_control & (convs_test != 0) & (imps_test != 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cr_test = convs_test / imps_test
+        cr_ctrl = convs_ctrl / imps_ctrl
+        lift = np.where((cr_ctrl == cr_test) | (cr_ctrl == 0) | (cr_test == 0), 0, (cr_test - cr_ctrl) / cr_ctrl)
+    lift = np.where(valid, lift, 0)
+
+    prob = np.zeros(convs_test.shape)
+    prob[valid] = prob_cache.cached_g_batch(
+        convs_test[valid] + 1, imps_test[valid] - convs_test[valid] + 1,
+        convs_ctrl[valid] + 1, imps_ctrl[valid] - convs_ctrl[valid] + 1,
+    )
+
+    return pd.DataFrame({
+        "variant": np.tile(variants, len(metrics)),
+        "metric": np.repeat([metric["display_name"] for metric in metrics], len(summary)),
+        "Impact": lift.T.ravel() * 100,
+        "Chance of being best": prob.T.ravel() * 100,
+    }, index=np.tile(summary.index, len(metrics)))
+
+# Monte Carlo counterpart of `bayes_batch`, with the extra statistics from `monte_carlo.simulate`.
+# Metrics sharing a denominator are simulated together so they reuse the same draws.
+@instrument.timed()
+def monte_carlo_batch(summary, metrics, control_name="Control", dimensions=None, draws=monte_carlo.DEFAULT_DRAWS, seed=monte_carlo.DEFAULT_SEED):
+    metrics = [metric for metric in metrics if metric["previous_step"] != None]
+    stats = ["Chance of being best", "Probability to be best", "Expected loss", "Impact lower", "Impact upper"]
+    results = []
+    partitions = summary.groupby(dimensions, sort=False, dropna=False) if dimensions else [(None, summary)]
+    for _, partition in partitions:
+        variants = partition["optimisation_variant"].tolist()
+        for denominator in dict.fromkeys(metric["previous_step"] for metric in metrics):
+            group = [metric for metric in metrics if metric["previous_step"] == denominator]
+            result = pd.DataFrame({
+                "variant": np.tile(variants, len(group)),
+                "metric": np.repeat([metric["display_name"] for metric in group], len(partition)),
+            }, index=np.tile(partition.index, len(group)))
+            imps = partition[denominator].to_numpy(dtype=float)
+            convs = np.vstack([partition[metric["name"]].to_numpy(dtype=float) for metric in group])
+            if control_name not in variants or imps[variants.index(control_name)] == 0:
+                result[["Impact"] + stats] = 0
+                results.append(result)
+                continue
+            control = variants.index(control_name)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rates = convs / imps
+                lift = np.where((rates == rates[:, [control]]) | (rates == 0) | (rates[:, [control]] == 0), 0, (rates - rates[:, [control]]) / rates[:, [control]])
+            sim = monte_carlo.simulate(convs, imps, control=control, draws=draws, seed=seed)
+            result["Impact"] = lift.ravel() * 100
+            for stat in stats:
+                result[stat] = sim[stat].ravel() * 100
+            results.append(result)
+    return pd.concat(results)
+
+# Bootstrap counterpart of `bayes_batch` for continuous metrics, resampling the `unit`s (e.g. users or days) of `data`
+# behind each summary row. Returns the same shape as `bayes_batch` plus the Impact interval. Partitions where a variant
+# has fewer than `bootstrap.MIN_UNITS` units are left as NaN for the caller to fill.
+@instrument.timed()
+def bootstrap_batch(data, summary, metrics, unit, control_name="Control", dimensions=None, resamples=bootstrap.DEFAULT_RESAMPLES, seed=bootstrap.DEFAULT_SEED, workers=bootstrap.DEFAULT_WORKERS):
+    metrics = [metric for metric in metrics if metric["previous_step"] != None]
+    stats = ["Impact", "Chance of being best", "Impact lower", "Impact upper"]
+    keys = ["optimisation_variant"] + (dimensions if dimensions else [])
+    columns = list(dict.fromkeys([metric["name"] for metric in metrics] + [metric["previous_step"] for metric in metrics]))
+    units = bootstrap.aggregate_units(data, keys, unit, columns)
+    rows = {key if isinstance(key, tuple) else (key,): frame for key, frame in units.groupby(keys, sort=False, dropna=False)}
+    summary_keys = list(summary[keys].itertuples(index=False, name=None))
+    partitions = summary.groupby(dimensions, sort=False, dropna=False).indices.values() if dimensions else [np.arange(len(summary))]
+
+    results = []
+    for metric in metrics:
+        values = {stat: np.full(len(summary), np.nan) for stat in stats}
+        for positions in partitions:
+            variants = summary["optimisation_variant"].to_numpy()[positions].tolist()
+            frames = [rows.get(summary_keys[position]) for position in positions]
+            if control_name not in variants or any(type(frame) == type(None) or frame.shape[0] < bootstrap.MIN_UNITS for frame in frames):
+                continue
+            result = bootstrap.bootstrap(
+                [frame[metric["name"]].to_numpy() for frame in frames],
+                [frame[metric["previous_step"]].to_numpy() for frame in frames],
+                control=variants.index(control_name), resamples=resamples, seed=seed, workers=workers,
+            )
+            for stat in stats:
+                values[stat][positions] = result[stat] * 100
+        result = pd.DataFrame({
+            "variant": summary["optimisation_variant"].to_numpy(),
+            "metric": metric["display_name"],
+        }, index=summary.index)
+        for stat in stats:
+            result[stat] = values[stat]
+        results.append(result)
+    if len(results) == 0:
+        return pd.DataFrame(columns=["variant", "metric"] + stats)
+    return pd.concat(results)
+
 def build_metric_object(order, name, display_name, previous_step):
     return {
         "order": order,
@@ -55,6 +206,13 @@ def build_metric_object(order, name, display_name, previous_step):
         "previous_step": previous_step,
     }
 
+# Column `calc_rate` adds for a metric
+def get_rate_column(metric):
+    if "revenue" in metric["name"].lower():
+        inferred_name = re.sub(r"_|revenue", "", metric["name"]).capitalize()
+        return f"Avg. {inferred_name} Value"
+    return f"{metric['display_name']} Rate"
+
 def calc_rate(src, metric, impressions="impressions", is_revenue = False, metric_name=False):
     if metric_name == False:
         metric_name = metric
@@ -77,7 +235,12 @@ def calc_sig(src, metric, impressions="impressions", metric_name=False, control_
     src[f"{metric_name} Significance"] = sig
     src[f"{metric_name} Impact"] = impact
 
-def summarise_test(details = None, data = None, metrics = [], dimensions = [], calc_significance = True, control_name = "Control"):
+# Revenue metrics (detected the same way as in `calc_rate`) are scored with `bootstrap_batch` when `revenue_engine` is
+# "bootstrap", resampling `unit` (the column `data` is broken down by, e.g. "user_pseudo_id"), or "event_date" by default.
+# Without a unit, or where a variant has fewer than `bootstrap.MIN_UNITS` units, their Significance is NaN: the Beta
+# comparison isn't valid for revenue. `revenue_engine="beta"` keeps the Beta comparison for every metric.
+@instrument.timed()
+def summarise_test(details = None, data = None, metrics = [], dimensions = [], calc_significance = True, control_name = "Control", grouped = True, revenue_engine = "bootstrap", unit = None):
     if type(details) != type(None):
         print(f"Test: {details.name.values[0]}")
         print(f"Description: {details.description.values[0]}")
@@ -94,18 +257,92 @@ def summarise_test(details = None, data = None, metrics = [], dimensions = [], c
         all_dimensions = ["optimisation_variant"] + dimensions
         summary = data[all_dimensions + metric_names + control_metric_names].groupby(by=all_dimensions).sum()
         summary = summary.reset_index()
+        if calc_significance:
+            # Grouped mode compares each variant with the control from the same dimension values
+            sig = bayes_batch(summary, metrics, control_name = control_name, dimensions = dimensions if grouped else None)
+            revenue_metrics = [metric for metric in metrics if metric["previous_step"] != None and "revenue" in metric["name"].lower()]
+            if revenue_engine == "bootstrap" and len(revenue_metrics) > 0:
+                if unit == None and bootstrap.DEFAULT_UNIT in data.columns:
+                    unit = bootstrap.DEFAULT_UNIT
+                if unit == None:
+                    print(f"No unit to bootstrap revenue metrics by (no '{bootstrap.DEFAULT_UNIT}' column), their significance is left empty")
+                    boot = pd.DataFrame({"metric": sig.metric, "Impact": np.nan, "Chance of being best": np.nan})
+                else:
+                    boot = bootstrap_batch(data, summary, revenue_metrics, unit, control_name = control_name, dimensions = dimensions if grouped else None)
+                for metric in revenue_metrics:
+                    rows = (sig.metric == metric["display_name"]).to_numpy()
+                    metric_boot = boot[boot.metric == metric["display_name"]]
+                    # The observed lift doesn't depend on the engine, only the chance of being best is left empty
+                    sig.loc[rows, "Impact"] = np.where(metric_boot["Impact"].isna(), sig.loc[rows, "Impact"].to_numpy(), metric_boot["Impact"].to_numpy())
+                    sig.loc[rows, "Chance of being best"] = metric_boot["Chance of being best"].to_numpy()
         for metric in metrics:
             summary[metric["display_name"]] = summary[metric["name"]]
             if metric["previous_step"] != None:
                 is_revenue = "revenue" in metric["name"].lower()
                 if calc_significance:
-                    calc_sig(summary, metric["name"], metric["previous_step"], metric["display_name"], control_name = control_name)
+                    metric_sig = sig[sig.metric == metric["display_name"]]
+                    summary[f"{metric['display_name']} Significance"] = metric_sig["Chance of being best"].to_numpy()
+                    summary[f"{metric['display_name']} Impact"] = metric_sig["Impact"].to_numpy()
                 calc_rate(summary, metric["name"], metric["previous_step"], is_revenue=is_revenue, metric_name=metric["display_name"])
         summary.drop(metric_names + control_metric_names, axis=1, inplace=True)
         return summary
     return None
 
-def visualise_summary(data, date = "", name = ""):
+# Cumulative totals per variant x dimension on the last day of a `summarise_test_over_time` result
+def get_cumulative_totals(result, metrics, keys, date_column="event_date"):
+    last_day = result[result[date_column] == result[date_column].max()]
+    totals = {}
+    for metric in metrics:
+        rows = last_day[last_day.metric == metric["display_name"]].set_index(keys)
+        totals[metric["name"]] = rows["Conversions"]
+        totals[metric["previous_step"]] = rows["Impressions"]
+    return pd.DataFrame(totals)
+
+# Daily cumulative Rate, Impact and Chance of being best as a long frame (one row per day x variant x dimension x metric).
+# Days are cumulated with one cumsum and every day is scored in a single `bayes_batch` call.
+# To extend an earlier result, pass it as `previous` with only the newly loaded days in `data`.
+@instrument.timed()
+def summarise_test_over_time(data, metrics = [], dimensions = [], control_name = "Control", previous = None, date_column = "event_date"):
+    metrics = [metric for metric in metrics if metric["previous_step"] != None]
+    columns = list(dict.fromkeys([metric["name"] for metric in metrics] + [metric["previous_step"] for metric in metrics]))
+    keys = ["optimisation_variant"] + dimensions
+    daily = data.groupby([date_column] + keys, observed=True)[columns].sum()
+
+    base = None
+    if type(previous) != type(None):
+        daily = daily[daily.index.get_level_values(date_column) > previous[date_column].max()]
+        base = get_cumulative_totals(previous, metrics, keys, date_column=date_column)
+    if daily.shape[0] == 0:
+        return previous
+
+    # Every variant x dimension gets a row on every day so totals carry through days without data
+    key_index = daily.index.droplevel(date_column).unique()
+    if type(base) != type(None):
+        key_index = key_index.union(base.index)
+    dates = daily.index.get_level_values(date_column).unique().sort_values()
+    grid = pd.MultiIndex.from_tuples([(date,) + (key if isinstance(key, tuple) else (key,)) for date in dates for key in key_index], names=[date_column] + keys)
+    cumulative = daily.reindex(grid, fill_value=0).groupby(level=keys, sort=False).cumsum()
+    if type(base) != type(None):
+        cumulative += base.reindex(cumulative.index.droplevel(date_column), fill_value=0)[columns].to_numpy()
+
+    summary = cumulative.reset_index()
+    sig = bayes_batch(summary, metrics, control_name = control_name, dimensions = [date_column] + dimensions)
+    result = summary.loc[sig.index, [date_column] + keys].reset_index(drop=True)
+    result["metric"] = sig["metric"].to_numpy()
+    result["Conversions"] = np.concatenate([summary[metric["name"]].to_numpy() for metric in metrics])
+    result["Impressions"] = np.concatenate([summary[metric["previous_step"]].to_numpy() for metric in metrics])
+    is_revenue = np.repeat(["revenue" in metric["name"].lower() for metric in metrics], summary.shape[0])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result["Rate"] = result["Conversions"] / result["Impressions"] * np.where(is_revenue, 1, 100)
+    result["Impact"] = sig["Impact"].to_numpy()
+    result["Chance of being best"] = sig["Chance of being best"].to_numpy()
+    if type(previous) != type(None):
+        result = pd.concat([previous, result], ignore_index=True)
+    return result
+
+# Melts a summary into the Rate / Impact / Significance frames plotted by `visualise_summary`,
+# as a job that `render.render_charts` can render alongside others
+def build_summary_job(data, date = "", name = ""):
     sig = data[[col for col in data.columns if "Significance" in col]].copy()
     sig.columns.name = ""
     sig.columns = [col.replace(" Significance", "") for col in sig.columns]
@@ -123,25 +360,18 @@ def visualise_summary(data, date = "", name = ""):
     rate.columns = [col.replace(" Rate", "") for col in rate.columns]
     rate.reset_index(inplace=True)
     rate = rate.melt(id_vars="optimisation_variant", var_name="Metric", value_name="Rate")
-    
-    fig, ax = plt.subplots(3, 1, figsize=(20, 15))
-    fig.suptitle(name, fontsize=16)
-    rate_bp = sns.barplot(data=rate, x="Metric", y="Rate", hue="optimisation_variant", palette=generated_palette, ax=ax[0])
-    imp_bp = sns.barplot(data=imp, x="Metric", y="Impact", hue="optimisation_variant", palette=generated_palette, ax=ax[1])
-    sig_bp = sns.barplot(data=sig, x="Metric", y="Significance", hue="optimisation_variant", palette=generated_palette, ax=ax[2])
-    ax[0].set_title("Rate", pad=10)
-    ax[1].set_title("Relative Impact", pad=10)
-    ax[2].set(ylim=(0, 100))
-    ax[2].set_title("Chance of being best", pad=10)
-    for bp in [imp_bp, sig_bp, rate_bp]:
-        bp.axhline(0, c="red")
-        for container in bp.containers:
-            bp.bar_label(container, fmt="%.2f%%")
-    plt.tight_layout()
+
+    return render.build_summary_chart_job(rate, imp, sig, name, generated_palette, render.chart_path(name, f"./visualisations/{date}/"))
+
+@instrument.timed()
+def visualise_summary(data, date = "", name = ""):
+    job = build_summary_job(data, date = date, name = name)
+    fig = render.draw_figure(job)
     if not os.path.exists(f"./visualisations/{date}/"):
         os.makedirs(f"./visualisations/{date}/")
     if name != None:
-        plt.savefig(f"./visualisations/{date}/{name}.png", format="png")
+        render.save_figure(fig, job["path"])
+    return fig
 
 DEFAULT_METRICS = [
     build_metric_object(0, "impressions", "Impressions", None),
@@ -0,0 +1,339 @@
+import os, sys, json, time, argparse, platform, subprocess, statistics, tempfile, tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Run in a fresh interpreter so imports and numba compilation are included in the timing
+FIRST_BAYES_SCRIPT = """
+import time
+start = time.perf_counter()
+import pandas as pd
+import libs.analysis as analysis
+data = pd.DataFrame({"optimisation_variant": ["Control", "Variation 1"], "impressions": [3068, 5159], "purchases": [139, 122]})
+analysis.bayes(data, impressions="impressions", goal="purchases")
+print(time.perf_counter() - start)
+"""
+
+# Seconds from interpreter start to the first `bayes()` result, once per fresh process.
+# Point `repo` at another checkout (e.g. a `git worktree` of an older commit) to compare before/after.
+def time_to_first_bayes(repeats=5, repo=REPO_ROOT, python=sys.executable):
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run([python, "-c", FIRST_BAYES_SCRIPT], cwd=repo, capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+# Large deck for `time_generate_report`: one "Chart and Data" slide per metric, with a `columns` wide table.
+# Every slide points at the same chart so the timing is dominated by slide and table building.
+GENERATE_REPORT_SCRIPT = """
+import sys, time, shutil, io, contextlib
+sys.path.insert(0, sys.argv[1])
+import libs.generate as generate
+slides, columns = int(sys.argv[2]), int(sys.argv[3])
+shutil.copy(sys.argv[4], "chart.png")
+header = [""] + ["Control"] + [f"Variation {col}" for col in range(1, columns - 1)]
+rows = [header] + [[f"Metric {row}"] + [f"{row * col * 1000:,}.{col:02d}%" for col in range(1, columns)] for row in range(5)]
+config = {"id": "BENCH", "content": [
+    {"name": f"Metric {i}", "type": "Metric", "layout": "Chart and Data", "title": f"Metric {i}", "segment": "All Users", "data": rows, "image_path": "./chart.png", "footer": "Segment definition: benchmark"}
+    for i in range(slides)
+]}
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    generate.generate_report(config)
+print(time.perf_counter() - start)
+"""
+BENCHMARK_CHART = REPO_ROOT / "example" / "visualisations" / "all_users-Purchases Rate.png"
+
+# Seconds for `generate.generate_report` to build and save a `slides` x `columns` deck, run in a scratch directory.
+# Only uses the original `generate_report(config)` signature, so older checkouts can be timed through `repo` too.
+def time_generate_report(slides=200, columns=15, repeats=3, repo=REPO_ROOT, python=sys.executable):
+    timings = []
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as scratch:
+            output = subprocess.run([python, "-c", GENERATE_REPORT_SCRIPT, str(repo), str(slides), str(columns), str(BENCHMARK_CHART)], cwd=scratch, capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+# Batch of `reports` copies of the example deck generated in one process, as when reporting on many tests at once
+BATCH_REPORTS_SCRIPT = """
+import sys, time, json, shutil, io, contextlib
+sys.path.insert(0, sys.argv[1])
+import libs.generate as generate
+reports = int(sys.argv[2])
+shutil.copytree(sys.argv[3] + "/visualisations", "visualisations")
+config = json.load(open(sys.argv[3] + "/slide_config.json"))
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    for i in range(reports):
+        generate.generate_report({**config, "id": f"BENCH{i:03d}"})
+print(time.perf_counter() - start)
+"""
+EXAMPLE_DIR = REPO_ROOT / "example"
+
+def time_batch_reports(reports=50, repeats=3, repo=REPO_ROOT, python=sys.executable):
+    timings = []
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as scratch:
+            output = subprocess.run([python, "-c", BATCH_REPORTS_SCRIPT, str(repo), str(reports), str(EXAMPLE_DIR)], cwd=scratch, capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+def print_timings(name, timings):
+    print(f"{name}: median {statistics.median(timings):.3f}s, min {min(timings):.3f}s, max {max(timings):.3f}s ({len(timings)} runs)")
+
+# Synthetic data, everything below runs offline
+
+DEFAULT_SEED = 42
+BASELINE_PATH = REPO_ROOT / "benchmarks" / "baseline.json"
+# A benchmark is flagged when its median is this many times its baseline median
+REGRESSION_THRESHOLD = 1.2
+# `calc_prob.g` walks a series as long as its last parameter, larger sizes are capped so it finishes in seconds
+EXACT_G_LIMIT = 10**6
+SEGMENT_VALUES = ["desktop", "tablet", "mobile", "app", "tv", "console", "other"]
+
+# Funnel of `metrics` steps after impressions, each the previous step's denominator
+def generate_metrics(metrics=3):
+    names = ["impressions"] + [f"step_{i}" for i in range(1, metrics + 1)]
+    return [
+        {"order": i, "name": name, "display_name": name.replace("_", " ").capitalize(), "previous_step": names[i - 1] if i > 0 else None}
+        for i, name in enumerate(names)
+    ]
+
+# Daily event counts shaped like the BigQuery export: one row per day x variant x device category.
+# `impressions` is the total across every row, each funnel step converts around 30% of the previous step with
+# a small lift per variant, so totals up to 10^8 impressions cost no more memory than small ones.
+def generate_events(impressions=10**6, variants=2, metrics=3, segments=3, days=14, seed=DEFAULT_SEED):
+    rng = np.random.default_rng(seed)
+    variant_names = ["Control"] + [f"Variation {i}" for i in range(1, variants)]
+    devices = (SEGMENT_VALUES * (segments // len(SEGMENT_VALUES) + 1))[:segments]
+    devices = [device if i < len(SEGMENT_VALUES) else f"{device}_{i}" for i, device in enumerate(devices)]
+    dates = pd.date_range("2023-11-20", periods=days)
+    grid = pd.MultiIndex.from_product([dates, variant_names, devices], names=["event_date", "optimisation_variant", "device_category"]).to_frame(index=False)
+    grid.insert(1, "optimisation_id", "bench")
+    rows = grid.shape[0]
+    grid["impressions"] = rng.multinomial(impressions, rng.dirichlet(np.full(rows, 10.0)))
+    lift = 1 + 0.02 * pd.factorize(grid["optimisation_variant"], sort=True)[0]
+    previous = grid["impressions"].to_numpy()
+    for metric in generate_metrics(metrics)[1:]:
+        grid[metric["name"]] = rng.binomial(previous, np.clip(0.3 * lift, 0, 1))
+        previous = grid[metric["name"]].to_numpy()
+    return grid
+
+# Variant x segment totals with the `control_<metric>` columns `summarise_test` expects, as the analysis notebook builds them
+def generate_summary_input(events, metrics):
+    names = [metric["name"] for metric in metrics]
+    data = events.rename(columns={"device_category": "segment"}).groupby(["segment", "optimisation_variant"], as_index=False)[names].sum()
+    control = data[data.optimisation_variant == "Control"][["segment"] + names]
+    control.columns = ["segment"] + [f"control_{name}" for name in names]
+    return data.merge(control, on="segment", how="left")
+
+# Summary table in the shape the analysis notebook passes to `export.format_series`
+def generate_table(variants=2, seed=DEFAULT_SEED):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Variant": ["Control"] + [f"Variation {i}" for i in range(1, variants)],
+        "Impressions": rng.integers(10**5, 10**7, variants),
+        "Purchases": rng.integers(10**3, 10**5, variants),
+        "Purchases Rate": rng.uniform(1, 5, variants),
+        "Impact": rng.uniform(-10, 10, variants),
+        "Chance of being best": rng.uniform(0, 100, variants),
+    })
+
+# Each benchmark takes the size parameters and returns the callable to time, so data generation isn't timed
+
+def bench_calc_prob_g(impressions, variants, metrics, segments, days):
+    import libs.calc_prob as calc_prob
+    imps = min(impressions, EXACT_G_LIMIT)
+    convs = imps // 20
+    # Warm up so numba compilation isn't part of the timing
+    calc_prob.g(2.0, 3.0, 2.0, 3.0)
+    return lambda: calc_prob.g(convs + 1.0, imps - convs + 1.0, convs * 0.98 + 1.0, imps - convs * 0.98 + 1.0)
+
+def bench_calc_prob_g_fast(impressions, variants, metrics, segments, days):
+    import libs.calc_prob as calc_prob
+    convs = impressions // 20
+    calc_prob.g_fast(2.0, 3.0, 2.0, 3.0)
+    return lambda: calc_prob.g_fast(convs + 1.0, impressions - convs + 1.0, convs * 0.98 + 1.0, impressions - convs * 0.98 + 1.0)
+
+def bench_bayes(impressions, variants, metrics, segments, days):
+    import libs.analysis as analysis
+    import libs.prob_cache as prob_cache
+    data = generate_events(impressions, variants, 1, 1, 1).groupby("optimisation_variant", as_index=False)[["impressions", "step_1"]].sum()
+    def run():
+        # Cleared every run so the series is computed rather than served from the cache
+        prob_cache.clear_cache()
+        for variant in data.optimisation_variant:
+            analysis.bayes(data, impressions="impressions", goal="step_1", variant=variant)
+    return run
+
+def bench_summarise_test(impressions, variants, metrics, segments, days):
+    import libs.analysis as analysis
+    import libs.prob_cache as prob_cache
+    metric_objects = generate_metrics(metrics)
+    data = generate_summary_input(generate_events(impressions, variants, metrics, segments, days), metric_objects)
+    def run():
+        prob_cache.clear_cache()
+        analysis.summarise_test(data=data, metrics=metric_objects, dimensions=["segment"])
+    return run
+
+def bench_format_series(impressions, variants, metrics, segments, days):
+    import libs.export as export
+    table = generate_table(variants)
+    format_map = {
+        "Impressions": export.format_int,
+        "Purchases": export.format_int,
+        "Purchases Rate": export.format_perc,
+        "Impact": export.format_perc,
+        "Chance of being best": export.format_perc,
+    }
+    def run():
+        for _ in range(segments * metrics):
+            export.format_series(table, format_map=format_map, transpose=True)
+    return run
+
+def bench_visualise(impressions, variants, metrics, segments, days):
+    import libs.export as export
+    table = generate_table(variants)
+    export.visualise(table, "Purchases Rate", "bench-warmup", ylim=6, to_disk=False)
+    return lambda: export.visualise(table, "Purchases Rate", "bench", ylim=6, to_disk=False)
+
+def bench_generate_report(impressions, variants, metrics, segments, days):
+    import libs.export as export
+    import libs.render as render
+    import libs.generate as generate
+    table = export.format_series(generate_table(variants), format_map={"Impressions": export.format_int, "Purchases": export.format_int}, transpose=True)
+    render.register_image("./visualisations/bench.png", BENCHMARK_CHART.read_bytes())
+    slides = []
+    for metric in generate_metrics(metrics)[1:]:
+        slides.append(export.generate_title_slide(title=metric["display_name"], subtitle="Metric"))
+        for segment in range(segments):
+            slides.append(export.generate_metric_slide(title=metric["display_name"], segment=f"Segment {segment}", data=table, image_path="./visualisations/bench.png", footer="Segment definition: benchmark"))
+    config = export.output_metric_to_config(slides, id="BENCH", write=False)
+    generate.create()
+    def run():
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                generate.generate_report(config, to_buffer=True)
+            finally:
+                sys.stdout = stdout
+    return run
+
+BENCHMARKS = {
+    "calc_prob.g": bench_calc_prob_g,
+    "calc_prob.g_fast": bench_calc_prob_g_fast,
+    "analysis.bayes": bench_bayes,
+    "analysis.summarise_test": bench_summarise_test,
+    "export.format_series": bench_format_series,
+    "export.visualise": bench_visualise,
+    "generate.generate_report": bench_generate_report,
+}
+
+def build_size(impressions=10**6, variants=2, metrics=3, segments=3, days=14):
+    return {"impressions": impressions, "variants": variants, "metrics": metrics, "segments": segments, "days": days}
+
+# Median/min/max of `repeats` timed runs, then one more run under tracemalloc for peak memory
+# (kept separate so tracing doesn't slow down the timed runs)
+def run_benchmark(name, size, repeats=5):
+    func = BENCHMARKS[name](**size)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"median": statistics.median(timings), "min": min(timings), "max": max(timings), "runs": repeats, "peak_memory": peak_memory}
+
+def run_suite(size=None, names=None, repeats=5):
+    if size == None:
+        size = build_size()
+    if names == None:
+        names = list(BENCHMARKS)
+    results = {}
+    for name in names:
+        results[name] = run_benchmark(name, size, repeats=repeats)
+        print_result(name, results[name])
+    return {"size": size, "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__, "results": results}
+
+def print_result(name, result):
+    print(f"{name:<28} median {result['median'] * 1000:>10.2f}ms, min {result['min'] * 1000:>10.2f}ms, max {result['max'] * 1000:>10.2f}ms, peak memory {result['peak_memory'] / 1024 / 1024:>8.2f}MiB ({result['runs']} runs)")
+
+def save_baseline(suite, path=BASELINE_PATH):
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, "w") as file:
+        json.dump(suite, file, indent=2)
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path, "r") as file:
+        return json.load(file)
+
+# Ratio of each benchmark's median and peak memory to the baseline's, returns the names that regressed.
+# Baselines recorded at a different size are still compared, but a warning is printed.
+def compare(suite, baseline, threshold=REGRESSION_THRESHOLD):
+    if suite["size"] != baseline["size"]:
+        print(f"Warning: baseline size {baseline['size']} differs from this run's {suite['size']}")
+    regressions = []
+    for name, result in suite["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        time_ratio = result["median"] / base["median"]
+        memory_ratio = result["peak_memory"] / base["peak_memory"] if base["peak_memory"] > 0 else 1
+        regressed = time_ratio > threshold or memory_ratio > threshold
+        if regressed:
+            regressions.append(name)
+        message = f"{name:<28} time x{time_ratio:.2f}, memory x{memory_ratio:.2f}"
+        if regressed:
+            print(f"\033[93m{message} - regression\033[0m")
+        else:
+            print(message)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the statistics and reporting hot paths on synthetic data.")
+    parser.add_argument("repo", nargs="?", default=str(REPO_ROOT), help="checkout to time the fresh-process startup and report benchmarks against")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--impressions", type=int, default=10**6, help="total impressions across the synthetic data, up to 10^8")
+    parser.add_argument("--variants", type=int, default=2)
+    parser.add_argument("--metrics", type=int, default=3)
+    parser.add_argument("--segments", type=int, default=3)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--save-baseline", nargs="?", const=str(BASELINE_PATH), default=None, help="store this run as the baseline")
+    parser.add_argument("--compare", nargs="?", const=str(BASELINE_PATH), default=None, help="compare this run against a stored baseline, exits 1 on regression and 2 when there is no baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--startup", action="store_true", help="also run the fresh-process startup and large deck benchmarks")
+    args = parser.parse_args(argv)
+
+    # Checked before running anything, so a missing baseline doesn't waste a full run
+    if args.compare != None and not os.path.exists(args.compare):
+        print(f"No baseline at {args.compare}, run with --save-baseline first to record one")
+        return 2
+
+    if args.startup:
+        print_timings("Time to first bayes()", time_to_first_bayes(repo=args.repo))
+        print_timings("generate_report(), 200 slides x 15 columns", time_generate_report(repo=args.repo))
+        print_timings("generate_report(), 50 reports in one process", time_batch_reports(repo=args.repo))
+
+    size = build_size(args.impressions, args.variants, args.metrics, args.segments, args.days)
+    suite = run_suite(size, names=args.only, repeats=args.repeats)
+    if args.save_baseline != None:
+        save_baseline(suite, args.save_baseline)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare != None:
+        print()
+        if len(compare(suite, load_baseline(args.compare), threshold=args.threshold)) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
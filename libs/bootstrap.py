@@ -0,0 +1,117 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_RESAMPLES = 2000
+DEFAULT_SEED = 42
+DEFAULT_INTERVAL = 0.95
+DEFAULT_WORKERS = os.cpu_count()
+# "poisson" draws Poisson(1) row counts, "bayesian" draws Dirichlet row weights (Rubin's Bayesian bootstrap)
+DEFAULT_METHOD = "poisson"
+# Weight matrix cells generated per chunk (resamples x rows), bounds the memory of each chunk to ~80MB
+CHUNK_CELLS = 10000000
+# Resamples are always split into this many seeded chunks, so results don't depend on the number of workers
+RESAMPLE_CHUNKS = 16
+# Below this many cells in total a process pool costs more than it saves
+PARALLEL_MIN_CELLS = 50000000
+# Unit resampled when none is given, if the data has it
+DEFAULT_UNIT = "event_date"
+# Variants with fewer units than this (e.g. two weeks of days) are left to the Beta comparison,
+# a bootstrap over a handful of rows mostly measures which rows happened to be drawn
+MIN_UNITS = 14
+
+# (resamples, rows) matrix of resampling weights. Dirichlet weights are left unnormalised as exponential draws,
+# the normalisation cancels out of the ratio estimate.
+def resample_weights(rng, resamples, rows, method=DEFAULT_METHOD):
+    if method == "bayesian":
+        return rng.standard_exponential((resamples, rows))
+    return rng.poisson(1.0, (resamples, rows)).astype(float)
+
+# Ratio of weighted sums (sum(w * numerator) / sum(w * denominator)) for each resample and variant.
+# Each variant is resampled independently, with its own weights.
+def resample_ratios(numerators, denominators, resamples, seed, method=DEFAULT_METHOD):
+    rng = np.random.default_rng(seed)
+    ratios = np.empty((resamples, len(numerators)))
+    for variant, (numerator, denominator) in enumerate(zip(numerators, denominators)):
+        chunk_size = max(1, CHUNK_CELLS // max(1, len(numerator)))
+        for start in range(0, resamples, chunk_size):
+            size = min(chunk_size, resamples - start)
+            weights = resample_weights(rng, size, len(numerator), method)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratios[start:start + size, variant] = (weights @ numerator) / (weights @ denominator)
+    return ratios
+
+# Arguments are sent once per worker rather than with every chunk
+WORKER_DATA = {}
+
+def set_worker_data(numerators, denominators, method):
+    WORKER_DATA["numerators"] = numerators
+    WORKER_DATA["denominators"] = denominators
+    WORKER_DATA["method"] = method
+
+def resample_worker_chunk(chunk):
+    resamples, seed = chunk
+    return resample_ratios(WORKER_DATA["numerators"], WORKER_DATA["denominators"], resamples, seed, WORKER_DATA["method"])
+
+# Bootstraps a ratio metric (e.g. revenue per purchase) from the rows behind each variant, per user or per day.
+# `numerators` and `denominators` hold one array of rows per variant, `denominators=None` bootstraps the mean per row.
+# Resamples are split into seeded chunks, spread across a process pool for large inputs, so results only depend on `seed`.
+# Returns arrays over variants of observed impact vs control, chance of beating control and the impact interval.
+def bootstrap(numerators, denominators=None, control=0, resamples=DEFAULT_RESAMPLES, seed=DEFAULT_SEED, method=DEFAULT_METHOD, interval=DEFAULT_INTERVAL, workers=DEFAULT_WORKERS):
+    numerators = [np.asarray(numerator, dtype=float) for numerator in numerators]
+    if type(denominators) == type(None):
+        denominators = [np.ones(len(numerator)) for numerator in numerators]
+    denominators = [np.asarray(denominator, dtype=float) for denominator in denominators]
+    rows = sum(len(numerator) for numerator in numerators)
+
+    chunks = max(1, min(resamples, RESAMPLE_CHUNKS))
+    sizes = [resamples // chunks + (1 if i < resamples % chunks else 0) for i in range(chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+    if workers != None and workers > 1 and rows * resamples >= PARALLEL_MIN_CELLS:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_worker_data, initargs=(numerators, denominators, method)) as pool:
+            ratios = np.vstack(list(pool.map(resample_worker_chunk, zip(sizes, seeds))))
+    else:
+        ratios = np.vstack([resample_ratios(numerators, denominators, size, chunk_seed, method) for size, chunk_seed in zip(sizes, seeds)])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        observed = np.array([numerator.sum() / denominator.sum() for numerator, denominator in zip(numerators, denominators)])
+        impact = np.where((observed == observed[control]) | (observed == 0) | (observed[control] == 0), 0, (observed - observed[control]) / observed[control])
+        lifts = (ratios - ratios[:, [control]]) / ratios[:, [control]]
+    # Ties count half, so the control scores 50% against itself as it does with `calc_prob`
+    chance = (ratios > ratios[:, [control]]).mean(axis=0) + 0.5 * (ratios == ratios[:, [control]]).mean(axis=0)
+    tail = (1 - interval) / 2
+    lower, upper = np.nanquantile(lifts, [tail, 1 - tail], axis=0)
+    return {
+        "Impact": impact,
+        "Chance of being best": chance,
+        "Impact lower": lower,
+        "Impact upper": upper,
+    }
+
+# Rows of `data` summed to one row per `keys` x `unit`, the unit being what's resampled (e.g. "user_pseudo_id" or "event_date")
+def aggregate_units(data, keys, unit, columns):
+    return data.groupby(keys + [unit], sort=False, dropna=False, observed=True)[columns].sum().reset_index()
+
+def has_enough_units(rows, impressions, goal):
+    return rows.shape[0] >= MIN_UNITS and rows[impressions].sum() != 0 and rows[goal].sum() != 0
+
+# Same dict shape as `analysis.bayes()`, resampling the `unit`s of `data` for the control and one variant.
+# Returns None when either has fewer than MIN_UNITS units, for the caller to fall back to the Beta comparison.
+def compare(data, unit, impressions="Sessions", goal="Transactions", control="Control", variant="Variation 1", name=None, resamples=DEFAULT_RESAMPLES, seed=DEFAULT_SEED, method=DEFAULT_METHOD, interval=DEFAULT_INTERVAL, workers=DEFAULT_WORKERS):
+    if name == None:
+        name = goal
+    data = aggregate_units(data[data["optimisation_variant"].isin([control, variant])], ["optimisation_variant"], unit, list(dict.fromkeys([impressions, goal])))
+    control_rows = data[data["optimisation_variant"] == control]
+    test_rows = data[data["optimisation_variant"] == variant]
+    if not has_enough_units(control_rows, impressions, goal) or not has_enough_units(test_rows, impressions, goal):
+        print(f"Not enough {unit} units to bootstrap, goal: {goal}, impressions: {impressions}")
+        return None
+    result = bootstrap(
+        [control_rows[goal].to_numpy(), test_rows[goal].to_numpy()],
+        [control_rows[impressions].to_numpy(), test_rows[impressions].to_numpy()],
+        control=0, resamples=resamples, seed=seed, method=method, interval=interval, workers=workers,
+    )
+    output = {"variant": variant, "metric": name}
+    for stat in result:
+        output[stat] = result[stat][1] * 100
+    return output
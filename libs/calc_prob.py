@@ -1,26 +1,121 @@
 from math import lgamma
 from numba import jit
 import numpy as np
+from scipy.special import gammaln, ndtr
+
+# Above this value for all four Beta parameters the series is replaced with a normal approximation
+APPROX_THRESHOLD = 100000
+# Number of series terms evaluated per NumPy chunk, bounds memory for very long series
+CHUNK_SIZE = 1000000
+
+# Kernels are compiled for explicit signatures and cached to __pycache__,
+# so only the first process after a change pays for numba compilation
+SIGNATURE_3 = "float64(float64, float64, float64)"
+SIGNATURE_4 = "float64(float64, float64, float64, float64)"
 
 #defining the functions used
-@jit
+@jit(SIGNATURE_4, nopython=True, cache=True)
 def h(a, b, c, d):
     num = lgamma(a + c) + lgamma(b + d) + lgamma(a + b) + lgamma(c + d)
     den = lgamma(a) + lgamma(b) + lgamma(c) + lgamma(d) + lgamma(a + b + c + d)
     return np.exp(num - den)
 
-@jit
+@jit(SIGNATURE_3, nopython=True, cache=True)
 def g0(a, b, c):    
     return np.exp(lgamma(a + b) + lgamma(a + c) - (lgamma(a + b + c) + lgamma(a)))
 
-@jit
 def hiter(a, b, c, d):
     while d > 1:
         d -= 1
         yield h(a, b, c, d) / d
 
+# Compiled equivalent of `sum(hiter(a, b, c, d))`
+@jit(SIGNATURE_4, nopython=True, cache=True)
+def hsum(a, b, c, d):
+    total = 0.0
+    while d > 1:
+        d -= 1
+        total += h(a, b, c, d) / d
+    return total
+
 def g(a, b, c, d):
-    return g0(a, b, c) + sum(hiter(a, b, c, d))
+    return g0(a, b, c) + hsum(a, b, c, d)
 
 def calc_prob_between(beta1, beta2):
-    return g(beta1.args[0], beta1.args[1], beta2.args[0], beta2.args[1])
\ No newline at end of file
+    return g(beta1.args[0], beta1.args[1], beta2.args[0], beta2.args[1])
+
+# P(X > Y) for X ~ Beta(a, b), Y ~ Beta(c, d) using a normal approximation of both posteriors
+def g_normal(a, b, c, d):
+    mean_x = a / (a + b)
+    mean_y = c / (c + d)
+    var_x = a * b / ((a + b) ** 2 * (a + b + 1))
+    var_y = c * d / ((c + d) ** 2 * (c + d + 1))
+    return ndtr((mean_x - mean_y) / np.sqrt(var_x + var_y))
+
+# Number of terms `hiter` yields for a given last parameter
+def series_length(d):
+    return np.where(d > 1, np.ceil(d) - 1, 0).astype(np.int64)
+
+# Vectorised equivalent of `g` over arrays of Beta parameters.
+# Each cell is rotated so the series runs over its smallest parameter:
+#   g(a, b, c, d) = g(d, c, b, a) = 1 - g(c, d, a, b) = 1 - g(b, a, d, c)
+# and all cells' series are evaluated as one flat, chunked NumPy reduction.
+def g_batch(a, b, c, d, threshold=APPROX_THRESHOLD):
+    a, b, c, d = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (a, b, c, d)])
+    shape = a.shape
+    params = np.stack([a.ravel(), b.ravel(), c.ravel(), d.ravel()])
+    result = np.zeros(params.shape[1])
+
+    # Beta parameters must be positive. Anything else (e.g. revenue or page views counted as conversions of a smaller
+    # denominator) has no probability, so it's returned as NaN rather than clipped into a confident 0 or 1.
+    invalid = ~(params > 0).all(axis=0)
+    use_normal = np.zeros(params.shape[1], dtype=bool)
+    if threshold is not None:
+        use_normal = (params > threshold).all(axis=0)
+        result[use_normal] = g_normal(*params[:, use_normal])
+
+    # The identities only hold for whole, positive parameters, anything else keeps the reference orientation
+    smallest = np.argmin(params, axis=0)
+    smallest[((params <= 0) | (params != np.round(params))).any(axis=0)] = 3
+    orientations = [
+        ((3, 2, 1, 0), False),
+        ((2, 3, 0, 1), True),
+        ((1, 0, 3, 2), True),
+        ((0, 1, 2, 3), False),
+    ]
+    A, B, C, D = np.empty_like(params)
+    complement = np.zeros(params.shape[1], dtype=bool)
+    for i, (order, flip) in enumerate(orientations):
+        mask = smallest == i
+        A[mask], B[mask], C[mask], D[mask] = params[list(order)][:, mask]
+        complement[mask] = flip
+
+    cells = np.flatnonzero(~use_normal & ~invalid)
+    A, B, C, D = A[cells], B[cells], C[cells], D[cells]
+    totals = np.exp(gammaln(A + B) + gammaln(A + C) - (gammaln(A + B + C) + gammaln(A)))
+
+    # Terms of cell i are h(A, B, C, D - k) / (D - k) for k = 1..counts[i]
+    counts = series_length(D)
+    ends = np.cumsum(counts)
+    constant = gammaln(A + C) + gammaln(A + B) - gammaln(A) - gammaln(B) - gammaln(C)
+    for start in range(0, int(ends[-1]) if len(ends) else 0, CHUNK_SIZE):
+        position = np.arange(start, min(start + CHUNK_SIZE, ends[-1]))
+        cell = np.searchsorted(ends, position, side="right")
+        k = position - (ends[cell] - counts[cell]) + 1
+        dk = D[cell] - k
+        log_terms = constant[cell] + gammaln(B[cell] + dk) + gammaln(C[cell] + dk) - gammaln(dk) - gammaln(A[cell] + B[cell] + C[cell] + dk)
+        totals += np.bincount(cell, weights=np.exp(log_terms) / dk, minlength=len(cells))
+
+    totals = np.where(complement[cells], 1 - totals, totals)
+    result[cells] = totals
+    # Only rounding error is clipped, the invalid cells are set afterwards
+    result = np.clip(result, 0, 1)
+    result[invalid] = np.nan
+    return result.reshape(shape)
+
+def g_fast(a, b, c, d, threshold=APPROX_THRESHOLD):
+    return float(g_batch(a, b, c, d, threshold=threshold))
+
+# Drop-in replacement for `calc_prob_between` whose cost doesn't grow with impressions
+def calc_prob_between_fast(beta1, beta2, threshold=APPROX_THRESHOLD):
+    return g_fast(beta1.args[0], beta1.args[1], beta2.args[0], beta2.args[1], threshold=threshold)
@@ -1,14 +1,14 @@
-import json, re, os
+import json
 import numpy as np
 
-import matplotlib.pyplot as plt
-import seaborn as sns
 import libs.analysis as analysis
+import libs.render as render
+import libs.instrument as instrument
 import pandas as pd
 
-generated_full_palette = sns.color_palette([ "#003f5c", "#2f4b7c", "#665191", "#a05195", "#d45087", "#f95d6a", "#ff7c43", "#ffa600", ], 8)
-generated_palette = sns.color_palette(["#003f5c", "#a05195", "#ffa600"], 3)
-generated_small_palette = sns.color_palette(["#003f5c", "#ffa600"], 2)
+generated_full_palette = [ "#003f5c", "#2f4b7c", "#665191", "#a05195", "#d45087", "#f95d6a", "#ff7c43", "#ffa600", ]
+generated_palette = ["#003f5c", "#a05195", "#ffa600"]
+generated_small_palette = ["#003f5c", "#ffa600"]
 colour_map = {
     "Control": "#003f5c",
     "Variation 1": "#58508d",
@@ -16,17 +16,17 @@ colour_map = {
     "Variation 3": "#ff6361",
     "Variation 4": "#ffa600",
 }
-sns.set_theme(style="darkgrid")
 
-def output_metric_to_config(slides, id="PAH000"):
+def output_metric_to_config(slides, id="PAH000", write=True):
     config_path = "./slide_config.json"
     config = {
         "id": id,
         "name": "Data Report",
         "content": slides
     }
-    config_file = open(config_path, "w+")
-    json.dump(config, config_file)
+    if write:
+        config_file = open(config_path, "w+")
+        json.dump(config, config_file)
     return config
 
 def generate_divider_slide(title=""):
@@ -114,16 +114,96 @@ def format_int(x):
 def format_rev(x):
     return f"£{x:0,.2f}"
 
+# Declarative column format for `format_values`: `decimals` places, thousands separators with `grouping`,
+# values divided by `divide_by` first, and `prefix` placed before the sign (as `format_rev` does) and `suffix` after
+def build_format_object(decimals=2, grouping=True, prefix="", suffix="", divide_by=1):
+    return {
+        "decimals": decimals,
+        "grouping": grouping,
+        "prefix": prefix,
+        "suffix": suffix,
+        "divide_by": divide_by,
+    }
+
+INT_FORMAT = build_format_object(decimals=0)
+FLOAT_FORMAT = build_format_object()
+PERC_FORMAT = build_format_object(grouping=False, suffix="%")
+RATIO_FORMAT = build_format_object(divide_by=100)
+REV_FORMAT = build_format_object(prefix="£")
+
+# The format functions above, as column formats that render the same strings without a Python call per cell
+FUNCTION_FORMATS = {
+    format_int: INT_FORMAT,
+    format_float: FLOAT_FORMAT,
+    format_perc: PERC_FORMAT,
+    format_perc_to_ratio: RATIO_FORMAT,
+    format_rev: REV_FORMAT,
+}
+
+# Inserts thousands separators into the integer part of unsigned number strings, all rows at once:
+# the right-aligned digits are laid out as a character grid and a comma column added after every third digit
+def group_thousands(strings):
+    parts = np.char.partition(strings, ".")
+    integers = parts[:, 0]
+    width = integers.dtype.itemsize // np.dtype("U1").itemsize
+    if width <= 3:
+        return strings
+    fractions = np.char.add(parts[:, 1], parts[:, 2])
+    lengths = np.char.str_len(integers)
+    chars = np.char.rjust(integers, width).view("U1").reshape(-1, width)
+
+    grouped_width = width + (width - 1) // 3
+    from_right = np.arange(grouped_width)[::-1]
+    is_comma = (from_right + 1) % 4 == 0
+    source = width - 1 - np.minimum(from_right - (from_right + 1) // 4, width - 1)
+    # A comma is only kept when there are digits on both sides of it
+    has_digits_left = lengths[:, None] > ((from_right + 1) // 4 * 3)[None, :]
+    grid = np.where(is_comma[None, :], np.where(has_digits_left, ",", " "), chars[:, source])
+    grouped = np.ascontiguousarray(grid).view(f"U{grouped_width}").ravel()
+    return np.char.add(np.char.lstrip(grouped), fractions)
+
+# Renders a whole column with a format object, matching Python's formatting of each value (including rounding)
+def format_values(values, spec):
+    values = np.asarray(values, dtype=float) / spec["divide_by"]
+    digits = np.char.mod(f"%.{spec['decimals']}f", np.abs(values))
+    if spec["grouping"]:
+        digits = group_thousands(digits)
+    signs = np.where(np.signbit(values), "-", "")
+    formatted = np.char.add(np.char.add(np.char.add(spec["prefix"], signs), digits), spec["suffix"]).astype(object)
+    # nan and inf are rare, they go through Python's formatting
+    not_finite = ~np.isfinite(values)
+    if not_finite.any():
+        python_format = f"{',' if spec['grouping'] else ''}.{spec['decimals']}f"
+        formatted[not_finite] = [f"{spec['prefix']}{value:{python_format}}{spec['suffix']}" for value in values[not_finite]]
+    return formatted
+
+# A format map value can be a format object, one of the format functions above, or any other callable (applied per cell)
+def format_column(series, fmt):
+    if isinstance(fmt, dict):
+        return format_values(series.to_numpy(), fmt)
+    if fmt in FUNCTION_FORMATS:
+        return format_values(series.to_numpy(), FUNCTION_FORMATS[fmt])
+    return series.apply(fmt).to_numpy(dtype=object)
+
+@instrument.timed()
 def format_series(d, format_map = None, rename_map = None, transpose=True):
-    data = d.copy()
-    if type(format_map) != type(None):
-        if "segment" in data.columns:
-            data = data.drop("segment", axis=1)
-        for column in data.columns:
-            if column in format_map:
-                data[column] = data[column].apply(format_map[column])
-    if type(rename_map) != type(None):
-        data.rename(columns = rename_map, inplace=True)
+    columns = {}
+    for column in d.columns:
+        if type(format_map) != type(None) and column == "segment":
+            continue
+        values = d[column].to_numpy()
+        if type(format_map) != type(None) and column in format_map:
+            values = format_column(d[column], format_map[column])
+        if type(rename_map) != type(None) and column in rename_map:
+            column = rename_map[column]
+        columns[column] = values
+    if transpose and all(values.dtype == object for column, values in columns.items() if column != "Variant"):
+        # Every cell is already a string, so the slide table is built directly rather than through a frame transpose
+        variants = columns.pop("Variant")
+        data = pd.DataFrame(np.array(list(columns.values()), dtype=object).reshape(len(columns), len(variants)), index=list(columns), columns=variants)
+        data.columns.name = ""
+        return data.reset_index(names="")
+    data = pd.DataFrame(columns, index=d.index)
     if transpose:
         data = transpose_data(data)
         return data.reset_index(names="")
@@ -134,21 +214,34 @@ def transpose_data(data):
     data.columns.name=""
     return data
 
-def visualise(data, kpi, name, ylim=.8, fmt="%.2f%%", extra_title="", hide=True, palette=colour_map):
-    plt.subplots(1, 1, figsize=(8, 8))
-    chart = sns.barplot(data=data, x="Variant", y=kpi, palette=palette)
-    if isinstance(ylim, (float, int)):
-        chart.set_ylim(0, ylim)
-    elif isinstance(ylim, tuple):
-        chart.set_ylim(ylim[0], ylim[1])
-    chart.set_xlabel("")
-    chart.set_ylabel("")
-    chart.set_title(f"{kpi} {extra_title}")
-    for container in chart.containers:
-        chart.bar_label(container, fmt=fmt)
-    plt.tight_layout()
-    if not os.path.exists(f"./visualisations/"):
-        os.makedirs(f"./visualisations/")
-    plt.savefig(f"./visualisations/{name}.png", format="png")
-    if hide:
-        plt.close()
\ No newline at end of file
+# Renders and saves one chart, `hide=False` also displays it inline when running under IPython
+# (without IPython installed the figure is only returned).
+# With `cache`, an unchanged chart (see `render.chart_hash`) is not re-rendered and None is returned.
+# With `in_memory`, the PNG is kept in `render.IMAGE_REGISTRY` for `generate`, and `to_disk=False` skips the file.
+@instrument.timed()
+def visualise(data, kpi, name, ylim=.8, fmt="%.2f%%", extra_title="", hide=True, palette=colour_map, cache=False, in_memory=False, to_disk=True):
+    job = build_visualisation_job(data, kpi, name, ylim=ylim, fmt=fmt, extra_title=extra_title, palette=palette)
+    if cache and hide:
+        render.render_charts([job], workers=1, cache=True, in_memory=in_memory, to_disk=to_disk)
+        return None
+    fig = render.draw_figure(job)
+    png = render.figure_to_png(fig)
+    if to_disk:
+        render.write_png(job["path"], png)
+    if in_memory or not to_disk:
+        render.register_image(job["path"], png)
+    if not hide:
+        try:
+            from IPython.display import display
+            display(fig)
+        except ImportError:
+            pass
+    return fig
+
+# Same arguments as `visualise`, queue the jobs and render them together with `visualise_all`
+def build_visualisation_job(data, kpi, name, ylim=.8, fmt="%.2f%%", extra_title="", palette=colour_map):
+    return render.build_chart_job(data, kpi, name, ylim=ylim, fmt=fmt, extra_title=extra_title, palette=palette)
+
+@instrument.timed()
+def visualise_all(jobs, workers=render.DEFAULT_WORKERS, cache=True, in_memory=False, to_disk=True):
+    return render.render_charts(jobs, workers=workers, cache=cache, in_memory=in_memory, to_disk=to_disk)
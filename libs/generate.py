@@ -1,18 +1,54 @@
 import json
 import libs.utils as utils
+import libs.render as render
+import libs.instrument as instrument
 import collections 
 import collections.abc
 from pptx import Presentation
 from random import randint
 from pathlib import Path
+from io import BytesIO
+from copy import deepcopy
 import numpy as np
 from pptx.util import Pt, Cm
 from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
-
-def create():
-    master_template_path = Path(__file__).with_name('template.pptx')
-    return Presentation(master_template_path)
-
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls, qn
+
+TEMPLATE_PATH = Path(__file__).with_name('template.pptx')
+# Parsed templates, loaded once per process and copied for every report
+TEMPLATE_CACHE = {}
+# Layout name -> {placeholder id: position in a new slide's shape tree}
+PLACEHOLDER_POSITIONS = {}
+
+def load_template(template_path=TEMPLATE_PATH):
+    template_path = str(template_path)
+    if template_path not in TEMPLATE_CACHE:
+        TEMPLATE_CACHE[template_path] = Presentation(template_path)
+    return TEMPLATE_CACHE[template_path]
+
+@instrument.timed()
+def create(template_path=TEMPLATE_PATH):
+    return deepcopy(load_template(template_path))
+
+# Layout name -> layout for a report, and the placeholder positions of every layout
+def build_layout_index(report):
+    layouts = {}
+    for layout in report.slide_layouts:
+        layouts[layout.name] = layout
+        if layout.name not in PLACEHOLDER_POSITIONS:
+            PLACEHOLDER_POSITIONS[layout.name] = {ph.placeholder_format.idx: position for position, ph in enumerate(layout.iter_cloneable_placeholders())}
+    return layouts
+
+# Saves the report to memory instead of disk, for read-only or ephemeral environments
+@instrument.timed()
+def save_to_buffer(report):
+    buffer = BytesIO()
+    report.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+@instrument.timed()
 def save(report, name):
     try:
         report.save(f'./{name}.pptx')
@@ -28,13 +64,23 @@ def get_layouts(report):
 def get_layout(report, name):
     return get_layouts(report).get_by_name(name)
 
+# New slides get their layout's placeholders in layout order, so a placeholder can be picked out by position
+# instead of searching the slide. Anything else (unindexed layouts, the template's own slides) falls back to the search.
+def get_placeholder(the_slide, placeholder_id):
+    positions = PLACEHOLDER_POSITIONS.get(the_slide.slide_layout.name)
+    if positions != None and placeholder_id in positions:
+        shape = the_slide.shapes[positions[placeholder_id]]
+        if shape.is_placeholder and shape.placeholder_format.idx == placeholder_id:
+            return shape
+    return the_slide.placeholders[placeholder_id]
+
 def update_title(the_slide, title_str):
     title = the_slide.shapes.title
     title.text = str(title_str)
 
 # Text specific functions
 def update_text_placeholder(the_slide, placeholder_id, content, size=None):
-    ph = the_slide.placeholders[placeholder_id]
+    ph = get_placeholder(the_slide, placeholder_id)
     ph.text = str(content)
     if size != None:
         for paragraph in ph.text_frame.paragraphs:
@@ -43,7 +89,7 @@ def update_text_placeholder(the_slide, placeholder_id, content, size=None):
 
 # Image specific functions
 def update_image_placeholder(the_slide, placeholder_id, image, scale_image=False):
-    ph = the_slide.placeholders[placeholder_id]
+    ph = get_placeholder(the_slide, placeholder_id)
     placeholder_height = ph.height
     placeholder_width = ph.width
     placeholder_top = ph.top
@@ -84,20 +130,47 @@ def update_image_placeholder(the_slide, placeholder_id, image, scale_image=False
     picture.crop_right = 0
 
 # Table specific functions
+# Centred single-run paragraph every table cell is written from, built once per table and copied per cell
+def build_cell_paragraph(size=None):
+    run_properties = "" if size == None else f'<a:rPr sz="{int(size * 100)}"/>'
+    return parse_xml(f'<a:p {nsdecls("a")}><a:pPr algn="ctr"/><a:r>{run_properties}<a:t/></a:r></a:p>')
+
+def write_cell_slow(tc, text, size=None):
+    tc.text = text
+    for paragraph in tc.text_frame.paragraphs:
+        paragraph.alignment = PP_ALIGN.CENTER
+        if size != None:
+            for run in paragraph.runs:
+                run.font.size = Pt(size)
+
+# Writes every cell in one pass over the table XML instead of going through the cell/paragraph/run proxies.
+# Text with line breaks or control characters goes through python-pptx so it's escaped the same way as before.
+def write_table(table, data, size=None):
+    paragraph = build_cell_paragraph(size)
+    empty_paragraph = deepcopy(paragraph)
+    empty_paragraph.remove(empty_paragraph.find(qn("a:r")))
+    tr_tag, tc_tag, p_tag, t_path = qn("a:tr"), qn("a:tc"), qn("a:p"), ".//" + qn("a:t")
+    for row_idx, (tr, row) in enumerate(zip(table._tbl.iterchildren(tr_tag), data)):
+        for col_idx, (tc, value) in enumerate(zip(tr.iterchildren(tc_tag), row)):
+            text = str(value)
+            if not text.isprintable():
+                write_cell_slow(table.cell(row_idx, col_idx), text, size)
+                continue
+            txBody = tc.get_or_add_txBody()
+            for p in txBody.findall(p_tag):
+                txBody.remove(p)
+            if text == "":
+                txBody.append(deepcopy(empty_paragraph))
+            else:
+                cell_paragraph = deepcopy(paragraph)
+                cell_paragraph.find(t_path).text = text
+                txBody.append(cell_paragraph)
+
 def update_table_placeholder(the_slide, placeholder_id, data, size=None):
     data = np.array(data)
-    ph = the_slide.placeholders[placeholder_id]
+    ph = get_placeholder(the_slide, placeholder_id)
     shape = ph.insert_table(rows=data.shape[0], cols=data.shape[1])
-    table = shape.table
-    for row in range(0, data.shape[0]):
-        for col in range(0, data.shape[1]):
-            tc = table.cell(row, col)
-            tc.text = data[row][col]
-            for paragraph in tc.text_frame.paragraphs:
-                paragraph.alignment = PP_ALIGN.CENTER
-                if size != None:
-                    for run in paragraph.runs:
-                        run.font.size = Pt(size)
+    write_table(shape.table, data, size)
 
 # Title specific functions
 def update_title_slide(the_slide, report_title, report_subtitle):
@@ -108,7 +181,7 @@ def update_notes_slide(the_slide, title, content):
     update_title(the_slide, title)
     update_text_placeholder(the_slide, 13, content)
 
-    ph = the_slide.placeholders[13]
+    ph = get_placeholder(the_slide, 13)
     tf = ph.text_frame
     first = True
     for note in content:
@@ -124,7 +197,7 @@ def update_device_report_slide(the_slide, title, content):
     update_title(the_slide, title)
     update_text_placeholder(the_slide, 13, content)
 
-    ph = the_slide.placeholders[13]
+    ph = get_placeholder(the_slide, 13)
     tf = ph.text_frame
     tf.text = content["title"]
     for point in content["points"]:
@@ -179,39 +252,47 @@ def update_chart_slide(the_slide, title, segment, image_path):
     update_text_placeholder(the_slide, 13, f"{segment}", size=12)
     update_image_placeholder(the_slide, 14, image_path, scale_image = True)
 
-def generate_report(config):
+# Images are taken from `images` (path -> PNG bytes, defaults to `render.IMAGE_REGISTRY`) when present, otherwise read from disk.
+# With `to_buffer`, the report is returned as a BytesIO instead of being saved.
+@instrument.timed()
+def generate_report(config, images=None, to_buffer=False):
     if type(config) == type(str):
         config = json.load(open(config))
     Report = create()
+    layouts = build_layout_index(Report)
     title_slide = get_title_slide(Report)
     update_title_slide(title_slide, f'{config["id"]}', "Post-Test Data Report")
     for content in config["content"]:
         layout_name = content["layout"]
         name = content["name"]
         print(f"Generating {layout_name} slide for {name}")
-        layout = Report.slide_layouts.get_by_name(layout_name)
-        new_slide = Report.slides.add_slide(layout)
+        with instrument.stage(f"generate.slide.{layout_name}"):
+            layout = layouts.get(layout_name)
+            new_slide = Report.slides.add_slide(layout)
 
-        if layout_name == "Title Slide 1" or layout_name == "Title Slide 2":
-            update_title_slide(new_slide, content["title"], content["subtitle"])
+            if layout_name == "Title Slide 1" or layout_name == "Title Slide 2":
+                update_title_slide(new_slide, content["title"], content["subtitle"])
 
-        elif layout_name == "Chart and Data":
-            update_chart_and_data_slide(new_slide, content["title"], content["segment"], content["data"], content["image_path"], content["footer"])
+            elif layout_name == "Chart and Data":
+                update_chart_and_data_slide(new_slide, content["title"], content["segment"], content["data"], render.get_image(content["image_path"], images), content["footer"])
 
-        elif "Divider Slide 1" in layout_name:
-            update_divider_slide(new_slide, content["title"])
+            elif "Divider Slide 1" in layout_name:
+                update_divider_slide(new_slide, content["title"])
             
-        elif "Long Form Messaging 1" in layout_name and "Report Info Slide" not in content["type"]:
-            update_notes_slide(new_slide, content["title"], content["content"])
+            elif "Long Form Messaging 1" in layout_name and "Report Info Slide" not in content["type"]:
+                update_notes_slide(new_slide, content["title"], content["content"])
             
-        elif "Long Form Messaging 1" in layout_name and "Report Info Slide" in content["type"]:
-            update_device_report_slide(new_slide, content["title"], content["content"])
+            elif "Long Form Messaging 1" in layout_name and "Report Info Slide" in content["type"]:
+                update_device_report_slide(new_slide, content["title"], content["content"])
 
-        elif "Heatmap" in layout_name:
-            update_heatmap_slide(new_slide, content["title"], content["segment"], content["image_path"])
+            elif "Heatmap" in layout_name:
+                update_heatmap_slide(new_slide, content["title"], content["segment"], render.get_image(content["image_path"], images))
 
-        elif "Chart Only" in layout_name:
-            update_chart_slide(new_slide, content["title"], content["segment"], content["image_path"])
+            elif "Chart Only" in layout_name:
+                update_chart_slide(new_slide, content["title"], content["segment"], render.get_image(content["image_path"], images))
     
+    if to_buffer:
+        utils.print_success("Report Generated Successfully")
+        return save_to_buffer(Report)
     save(Report, f'{config["id"]} - Post-Test Data Report')
     utils.print_success("Report Generated Successfully")
@@ -1,12 +1,31 @@
-import os, datetime
+import os, json, datetime
 import pandas as pd
+import libs.utils as utils
+import libs.instrument as instrument
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+DEFAULT_SHARD_WORKERS = 4
+DEFAULT_SHARD_RETRIES = 2
+
+@instrument.timed()
 def run_and_return(query, name):
     print(f"Running query for {name}")
     df = pd.read_gbq(query=query, progress_bar_type="tqdm", project_id="petsathome-analytics-service")
     print(f"Query complete for {name}")
     return df
 
+# Query runners take the processed query, a name and the date range it covers, and return a DataFrame
+def bigquery_runner(query, name, start_date, end_date):
+    return run_and_return(query, name)
+
+# Runner that serves rows from a local DataFrame instead of BigQuery, for offline runs and replays
+def frame_runner(df):
+    def runner(query, name, start_date, end_date):
+        print(f"Serving local data for {name}")
+        dates = pd.to_datetime(df["event_date"])
+        return df[(dates >= start_date) & (dates <= end_date)].copy()
+    return runner
+
 def get_query(path):
     with open(path, 'r') as file:
         query = file.read()
@@ -16,13 +35,95 @@ def get_local_data(path):
     df = pd.read_csv(path, parse_dates=["event_date"], date_parser=pd.to_datetime, index_col="Unnamed: 0")
     return df
 
+def get_local_parquet_data(path, start_date=None, end_date=None):
+    return utils.load_partitioned_df(path, start_date=start_date, end_date=end_date)
+
+# Latest day in a partitioned store, read from the partition directory names without loading any rows
+def get_latest_partition_date(path):
+    dates = [entry.name[len(utils.DATE_PARTITION_PREFIX):] for entry in os.scandir(path) if entry.is_dir() and entry.name.startswith(utils.DATE_PARTITION_PREFIX)]
+    if len(dates) == 0:
+        return None
+    return datetime.datetime.strptime(max(dates), "%Y-%m-%d")
+
+# Writes one Parquet file per day, re-pulling a day replaces that day's file
+@instrument.timed()
+def write_partitions(df, path):
+    days = pd.to_datetime(df["event_date"]).dt.strftime("%Y-%m-%d")
+    for day, day_data in df.drop("event_date", axis=1).groupby(days):
+        partition_dir = os.path.join(path, f"{utils.DATE_PARTITION_PREFIX}{day}")
+        if not os.path.exists(partition_dir):
+            os.makedirs(partition_dir)
+        day_data.to_parquet(os.path.join(partition_dir, "data.parquet"), index=False)
+
+# Shards still to be pulled into a local store, saved beside it. Every shard is recorded before it's queried and
+# removed once written, so a shard that failed all its retries (or was cut off) is re-queued on the next run.
+def get_pending_path(query_output_path):
+    return query_output_path.rstrip("/") + ".pending.json"
+
+def load_pending_shards(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        return [(datetime.datetime.strptime(start, "%Y-%m-%d"), datetime.datetime.strptime(end, "%Y-%m-%d")) for start, end in json.load(file)]
+
+def save_pending_shards(path, shards):
+    if len(shards) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w") as file:
+        json.dump([[f"{start:%Y-%m-%d}", f"{end:%Y-%m-%d}"] for start, end in sorted(shards)], file, indent=2)
+
 def process_query(query, start_date, end_date):
     processed_query = query
     processed_query = processed_query.replace("{{ @START_DATE }}", '"' + start_date + '"')
     processed_query = processed_query.replace("{{ @END_DATE }}", '"' + end_date + '"')
     return processed_query
 
-def update_local_data(query_name, TEST_start_date="2023-04-24", TEST_ID = "pah000"):
+# Splits start_date..end_date (both inclusive) into consecutive ranges of `days` days
+def shard_dates(start_date, end_date, days=1):
+    shards = []
+    shard_start = start_date
+    while shard_start <= end_date:
+        shard_end = min(shard_start + datetime.timedelta(days=days - 1), end_date)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end + datetime.timedelta(days=1)
+    return shards
+
+# Runs each shard's query through a bounded thread pool and passes every result to `on_shard` as it lands.
+# Only the shards that failed are retried, up to `retries` more times.
+@instrument.timed()
+def run_shards(query, name, shards, on_shard, runner=bigquery_runner, max_workers=DEFAULT_SHARD_WORKERS, retries=DEFAULT_SHARD_RETRIES):
+    pending = list(shards)
+    for attempt in range(retries + 1):
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for shard_start, shard_end in pending:
+                shard_name = f"{name} {shard_start:%Y-%m-%d} to {shard_end:%Y-%m-%d}"
+                shard_query = process_query(query, shard_start.strftime('%Y-%m-%d'), shard_end.strftime('%Y-%m-%d'))
+                futures[pool.submit(runner, shard_query, shard_name, shard_start, shard_end)] = (shard_start, shard_end)
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    utils.print_error(f"Query failed for {name} {shard[0]:%Y-%m-%d} to {shard[1]:%Y-%m-%d}: {e}")
+                    failed.append(shard)
+                    continue
+                on_shard(shard, data)
+        pending = failed
+        if len(pending) == 0:
+            return
+    failed_str = ", ".join(f"{start:%Y-%m-%d} to {end:%Y-%m-%d}" for start, end in pending)
+    raise RuntimeError(f"{len(pending)} shard(s) of '{name}' failed after {retries + 1} attempts: {failed_str}")
+
+# `storage` is either "csv" (a single file) or "parquet" (a directory partitioned by event_date).
+# With `shard_days`, the date range is pulled as concurrent shards of that many days, each written as it lands.
+# Shards land out of order, so the latest day written doesn't mean every earlier day is there: shards left over
+# from an earlier run are pulled again first (see `get_pending_path`).
+@instrument.timed()
+def update_local_data(query_name, TEST_start_date="2023-04-24", TEST_ID = "pah000", storage="csv", shard_days=None, max_workers=DEFAULT_SHARD_WORKERS, retries=DEFAULT_SHARD_RETRIES, runner=bigquery_runner):
     data_dir = f"./data/"
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
@@ -31,26 +132,59 @@ def update_local_data(query_name, TEST_start_date="2023-04-24", TEST_ID = "pah00
     if not os.path.exists(query_dir):
         os.makedirs(query_dir)
     
-    query_output_path = data_dir + query_name + ".csv"
     query = get_query(query_dir + query_name + ".sql")
+    local_data = None
+    most_recent_date = None
+
+    if storage == "parquet":
+        query_output_path = data_dir + query_name
+        if os.path.exists(query_output_path):
+            most_recent_date = get_latest_partition_date(query_output_path)
+    else:
+        query_output_path = data_dir + query_name + ".csv"
+        if os.path.exists(query_output_path):
+            local_data = get_local_data(query_output_path)
+            most_recent_date = local_data.event_date.max()
 
-    if os.path.exists(query_output_path):
-        local_data = get_local_data(query_output_path)
-        most_recent_date = local_data.event_date.max()
+    if most_recent_date != None:
         start_date = (most_recent_date + datetime.timedelta(days=1))
     else:
         start_date = datetime.datetime.strptime(TEST_start_date, "%Y-%m-%d")
 
+    pending_path = get_pending_path(query_output_path)
+    pending = load_pending_shards(pending_path)
+    if len(pending) > 0:
+        # Every day up to the last pending shard was either written or is still pending
+        start_date = max(start_date, max(end for _, end in pending) + datetime.timedelta(days=1))
+        print(f"Re-queuing {len(pending)} unfinished shard(s) of '{query_name}'")
+
     yesterday = (datetime.datetime.today() - datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    if start_date < yesterday:
+    if (start_date < yesterday and shard_days != None) or len(pending) > 0:
+        shards = list(pending)
+        if start_date < yesterday:
+            shards += shard_dates(start_date, yesterday, shard_days if shard_days != None else (yesterday - start_date).days + 1)
+        remaining = set(shards)
+        save_pending_shards(pending_path, remaining)
+        def write_shard(shard, data):
+            if storage == "parquet":
+                write_partitions(data, query_output_path)
+            else:
+                data.to_csv(query_output_path, mode="a", header=not os.path.exists(query_output_path))
+            remaining.discard(shard)
+            save_pending_shards(pending_path, remaining)
+        run_shards(query, query_name, shards, write_shard, runner=runner, max_workers=max_workers, retries=retries)
+        print(f"Existing '{query_name}' data is now up to date.")
+    elif start_date < yesterday:
         end_date_str = yesterday.strftime('%Y-%m-%d')
         start_date_str = start_date.strftime('%Y-%m-%d')
         processed_query = process_query(query, start_date_str, end_date_str)
-        data = run_and_return(processed_query, query_name)
-        if os.path.exists(query_output_path):
-            local_data = get_local_data(query_output_path)
-            data = pd.concat([data, local_data], axis=0)
-        data.to_csv(query_output_path)
+        data = runner(processed_query, query_name, start_date, yesterday)
+        if storage == "parquet":
+            write_partitions(data, query_output_path)
+        else:
+            if type(local_data) != type(None):
+                data = pd.concat([data, local_data], axis=0)
+            data.to_csv(query_output_path)
         print(f"Existing '{query_name}' data is now up to date.")
     else:
         print(f"Existing '{query_name}' data is up to date.")
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os, json, time, threading, tracemalloc, functools
+from contextlib import contextmanager, nullcontext
+
+# Instrumentation is off unless `enable()` is called, stages and timed functions then cost one flag check
+ENABLED = False
+TRACE_MEMORY = False
+# Stage name -> {"calls", "total", "max", "peak_memory"}, times in seconds and memory in bytes
+STATS = {}
+# Chrome trace "complete" events, one per stage call
+EVENTS = []
+LOCK = threading.Lock()
+LOCAL = threading.local()
+NULL_STAGE = nullcontext()
+
+# `memory` traces allocations with tracemalloc for peak memory per stage, which slows the run down noticeably
+def enable(memory=True):
+    global ENABLED, TRACE_MEMORY
+    ENABLED = True
+    TRACE_MEMORY = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global ENABLED, TRACE_MEMORY
+    ENABLED = False
+    if TRACE_MEMORY and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    TRACE_MEMORY = False
+
+def reset():
+    with LOCK:
+        STATS.clear()
+        EVENTS.clear()
+
+def get_stack():
+    if not hasattr(LOCAL, "stack"):
+        LOCAL.stack = []
+    return LOCAL.stack
+
+def record(name, timestamp, duration, peak_memory):
+    with LOCK:
+        stats = STATS.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0, "peak_memory": 0})
+        stats["calls"] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        event = {"name": name, "ph": "X", "ts": timestamp * 1e6, "dur": duration * 1e6, "pid": os.getpid(), "tid": threading.get_ident()}
+        if peak_memory != None:
+            stats["peak_memory"] = max(stats["peak_memory"], peak_memory)
+            event["args"] = {"peak_memory": peak_memory}
+        EVENTS.append(event)
+
+# tracemalloc only keeps one peak, so it's reset when a stage opens and each open stage keeps the highest
+# peak seen while it was open. A nested stage's peak is handed back to its parent when it closes.
+@contextmanager
+def traced_stage(name):
+    stack = get_stack()
+    memory = TRACE_MEMORY and tracemalloc.is_tracing()
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        if len(stack) > 0:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        tracemalloc.reset_peak()
+    frame = {"start_memory": current if memory else 0, "peak": current if memory else 0}
+    stack.append(frame)
+    # Wall-clock timestamps so events from worker processes line up once merged
+    timestamp = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        peak_memory = None
+        if memory:
+            frame["peak"] = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            peak_memory = frame["peak"] - frame["start_memory"]
+            if len(stack) > 0:
+                stack[-1]["peak"] = max(stack[-1]["peak"], frame["peak"])
+        record(name, timestamp, duration, peak_memory)
+
+# `with instrument.stage("name"):` times the block when instrumentation is enabled
+def stage(name):
+    if not ENABLED:
+        return NULL_STAGE
+    return traced_stage(name)
+
+# Decorator timing every call of a function as a stage, named `module.function` unless `name` is given
+def timed(name=None):
+    def decorator(func):
+        label = name if name != None else f"{func.__module__.replace('libs.', '')}.{func.__qualname__}"
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with traced_stage(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Stats and events recorded in this process, e.g. to send back from a worker process and `merge` in the parent
+def collect():
+    with LOCK:
+        return {"stats": {name: dict(stats) for name, stats in STATS.items()}, "events": list(EVENTS)}
+
+def merge(collected):
+    with LOCK:
+        for name, other in collected["stats"].items():
+            stats = STATS.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0, "peak_memory": 0})
+            stats["calls"] += other["calls"]
+            stats["total"] += other["total"]
+            stats["max"] = max(stats["max"], other["max"])
+            stats["peak_memory"] = max(stats["peak_memory"], other["peak_memory"])
+        EVENTS.extend(collected["events"])
+
+# Stages sorted by total time, slowest first
+def summary():
+    with LOCK:
+        return {name: dict(stats) for name, stats in sorted(STATS.items(), key=lambda item: -item[1]["total"])}
+
+def print_summary():
+    print(f"{'stage':<48}{'calls':>8}{'total':>12}{'mean':>12}{'max':>12}{'peak memory':>16}")
+    for name, stats in summary().items():
+        print(f"{name:<48}{stats['calls']:>8}{stats['total']:>11.3f}s{stats['total'] / stats['calls']:>11.3f}s{stats['max']:>11.3f}s{stats['peak_memory'] / 1024 / 1024:>13.1f}MiB")
+
+def write_summary(path):
+    with open(path, "w") as file:
+        json.dump(summary(), file, indent=2)
+
+# Viewable in chrome://tracing or https://ui.perfetto.dev
+def write_chrome_trace(path):
+    with LOCK:
+        trace = {"traceEvents": sorted(EVENTS, key=lambda event: event["ts"]), "displayTimeUnit": "ms"}
+    with open(path, "w") as file:
+        json.dump(trace, file)
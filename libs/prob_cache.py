@@ -0,0 +1,90 @@
+import os, sqlite3
+from collections import OrderedDict
+import numpy as np
+
+from libs.calc_prob import g_batch
+
+# Most recently used results kept in memory
+MAX_ENTRIES = 100000
+# Beta parameters are rounded to this many decimals before being used as a key
+CACHE_DECIMALS = 6
+DEFAULT_DISK_PATH = "./data/calc_prob_cache.sqlite"
+
+_memory = OrderedDict()
+_disk = None
+_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+def cache_key(a, b, c, d):
+    return tuple(round(float(x), CACHE_DECIMALS) for x in (a, b, c, d))
+
+# Persists results to a sqlite file so they survive between runs
+def enable_disk_cache(path=DEFAULT_DISK_PATH):
+    global _disk
+    disable_disk_cache()
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory)
+    _disk = sqlite3.connect(path)
+    _disk.execute("CREATE TABLE IF NOT EXISTS results (a REAL, b REAL, c REAL, d REAL, prob REAL, PRIMARY KEY (a, b, c, d))")
+    _disk.commit()
+
+def disable_disk_cache():
+    global _disk
+    if _disk is not None:
+        _disk.close()
+    _disk = None
+
+def cache_info():
+    return {**_stats, "size": len(_memory), "max_entries": MAX_ENTRIES, "disk": _disk is not None}
+
+def clear_cache():
+    _memory.clear()
+    for stat in _stats:
+        _stats[stat] = 0
+
+def _remember(key, value):
+    _memory[key] = value
+    _memory.move_to_end(key)
+    if len(_memory) > MAX_ENTRIES:
+        _memory.popitem(last=False)
+
+# Cached `calc_prob.g_batch`, only the cells missing from both caches are computed
+def cached_g_batch(a, b, c, d):
+    a, b, c, d = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (a, b, c, d)])
+    keys = [cache_key(*params) for params in zip(a.ravel(), b.ravel(), c.ravel(), d.ravel())]
+    values = np.empty(len(keys))
+    missing = []
+    for i, key in enumerate(keys):
+        if key in _memory:
+            _memory.move_to_end(key)
+            values[i] = _memory[key]
+            _stats["hits"] += 1
+        else:
+            missing.append(i)
+
+    if len(missing) > 0 and _disk is not None:
+        still_missing = []
+        for i in missing:
+            row = _disk.execute("SELECT prob FROM results WHERE a = ? AND b = ? AND c = ? AND d = ?", keys[i]).fetchone()
+            if row is None:
+                still_missing.append(i)
+            else:
+                values[i] = row[0]
+                _remember(keys[i], row[0])
+                _stats["disk_hits"] += 1
+        missing = still_missing
+
+    if len(missing) > 0:
+        params = np.array([keys[i] for i in missing]).T
+        computed = g_batch(*params)
+        for i, value in zip(missing, computed):
+            values[i] = value
+            _remember(keys[i], float(value))
+        _stats["misses"] += len(missing)
+        if _disk is not None:
+            _disk.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", [keys[i] + (float(values[i]),) for i in missing])
+            _disk.commit()
+    return values.reshape(a.shape)
+
+def cached_g(a, b, c, d):
+    return float(cached_g_batch(a, b, c, d))
@@ -4,8 +4,19 @@ import pandas as pd
 
 from scipy import stats
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.preprocessing import StandardScaler
 
+# Catalog of the processed reports, kept alongside them in the report path
+REPORT_INDEX_NAME = "report_index.json"
+# Version strings built by `get_version_str`, e.g. v1d2m3s4e5
+VERSION_PATTERN = re.compile(r"v[^_]+?d[^_]+?m[^_]+?s[^_]+?e[^_]+")
+DEFAULT_READ_WORKERS = 8
+# Rows kept by the reservoir behind the approximate quantiles, columns with fewer rows get exact quantiles
+DEFAULT_SAMPLE_SIZE = 1000000
+DEFAULT_CHUNK_SIZE = 1000000
+
 def output_df_to_csv(df, name):
     output_path = get_output_path()
     if not os.path.exists(output_path):
@@ -22,19 +33,43 @@ def calc_delta(control_value, variant_value):
 
 # Calcs % change between each value and the first value
 def calc_deltas(series):
-    deltas = [] 
-    for x in range(0, series.shape[0]):
-        delta = calc_delta(series.iloc[0], series.iloc[x])
-        deltas.append(delta)
-    return deltas
-
-# Calcs the rate and delta of specifed col (numerator) and returns new df
-def calc_rate_and_delta(df, numerator,  divisor):
-    processed = df.copy()
+    values = series.to_numpy()
+    return calc_delta(values[0], values).tolist()
+
+# Calcs the rate and delta of specifed col (numerator) and returns new df, or adds them to `df` with `inplace`
+def calc_rate_and_delta(df, numerator,  divisor, inplace = False):
+    processed = df if inplace else df.copy()
     processed[f"{numerator} Rate"] = (processed[numerator] / processed[divisor]) * 100
     processed[f"{numerator} Diff"] = calc_deltas(processed[f"{numerator} Rate"])
     return processed
 
+# Adds the rate of each numerator and its delta against a baseline row from the same group (e.g. segment x date) to `df`,
+# for every group in one pass and without copying the frame. The baseline is the `control_name` row of `variant_column`
+# when given, otherwise the group's first row as in `calc_deltas`. Groups without a baseline get NaN deltas.
+def calc_grouped_rate_and_delta(df, numerators, divisor, groups = [], variant_column = None, control_name = "Control"):
+    if isinstance(numerators, str):
+        numerators = [numerators]
+    rows = df.shape[0]
+    if len(groups) > 0:
+        codes = df.groupby(groups, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    else:
+        codes = np.zeros(rows, dtype=np.int64)
+    group_count = codes.max() + 1 if rows > 0 else 0
+    if variant_column != None:
+        baseline_rows = np.flatnonzero(df[variant_column].to_numpy() == control_name)
+    else:
+        baseline_rows = np.full(group_count, rows)
+        np.minimum.at(baseline_rows, codes, np.arange(rows))
+    divisor_values = df[divisor].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for numerator in numerators:
+            rate = df[numerator].to_numpy(dtype=float) / divisor_values * 100
+            baseline = np.full(group_count, np.nan)
+            baseline[codes[baseline_rows]] = rate[baseline_rows]
+            df[f"{numerator} Rate"] = rate
+            df[f"{numerator} Diff"] = calc_delta(baseline[codes], rate)
+    return df
+
 # Return all processed report file names
 def get_processed_report_names():
     files = next(os.walk(get_report_path()), (None, None, []))[2]  # [] if no file
@@ -44,27 +79,103 @@ def get_processed_report_names():
             processed_reports.append(file)
     return processed_reports
 
-# Returns single DataFrame of all reports that match a specified name
-def load_reports(name, current_version_only = True):
-    processed_report_names = get_processed_report_names()
-    relevant_reports = []
+def read_processed_report(path):
+    df = pd.read_csv(path)
+    if "Date" in df.columns:
+        df["Date"] = pd.to_datetime(df["Date"].astype(str), format="%Y%m%d")
+    return df
+
+# Index entry for one processed report file, the name is what's left of the file name after the version string
+def build_report_entry(file, mtime, size, rows, start, end):
+    version = VERSION_PATTERN.search(file)
+    name = file[:-len(".csv")]
+    if version != None:
+        name = name[version.end():].lstrip("_")
+    return {
+        "file": file,
+        "name": name,
+        "version": version.group() if version != None else None,
+        "start": start,
+        "end": end,
+        "rows": rows,
+        "mtime": mtime,
+        "size": size,
+    }
+
+# Only one column is read: the dates, or the first column to count the rows of a report without dates
+def index_report(path, file, mtime, size):
+    report_path = os.path.join(path, file)
+    columns = pd.read_csv(report_path, nrows=0).columns
+    column = "Date" if "Date" in columns else columns[0]
+    values = pd.read_csv(report_path, usecols=[column])[column]
+    start = end = None
+    if column == "Date" and values.shape[0] > 0:
+        dates = pd.to_datetime(values.astype(str), format="%Y%m%d")
+        start, end = dates.min().strftime("%Y-%m-%d"), dates.max().strftime("%Y-%m-%d")
+    return build_report_entry(file, mtime, size, int(values.shape[0]), start, end)
+
+def load_report_index(path):
+    index_path = os.path.join(path, REPORT_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, "r") as file:
+        return json.load(file)
+
+def save_report_index(path, index):
+    with open(os.path.join(path, REPORT_INDEX_NAME), "w") as file:
+        json.dump(index, file, indent=2, sort_keys=True)
+
+# Brings the persisted index up to date with one directory scan. Only files that are new or whose
+# size or mtime changed are read (in parallel), and entries for deleted files are dropped.
+def update_report_index(path=None, workers=DEFAULT_READ_WORKERS):
+    if path == None:
+        path = get_report_path()
+    if not os.path.exists(path):
+        return {}
+    index = load_report_index(path)
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and ".csv" in entry.name:
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime, stat.st_size)
+    stale = [file for file, (mtime, size) in files.items() if file not in index or index[file]["mtime"] != mtime or index[file]["size"] != size]
+    removed = [file for file in index if file not in files]
+    if len(stale) == 0 and len(removed) == 0:
+        return index
+    for file in removed:
+        del index[file]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in pool.map(lambda file: index_report(path, file, *files[file]), stale):
+            index[entry["file"]] = entry
+    save_report_index(path, index)
+    return index
 
+# Index entries matching a report name the same way file names were matched before, optionally only
+# reports with data between two dates
+def find_reports(name, current_version_only = True, start_date = None, end_date = None, path = None):
     if current_version_only:
-        version_str = get_version_str()
-        name = f"{version_str}_{name}"
-
-    for processed_report in processed_report_names:
-        if f"{name}.csv" in processed_report:
-            relevant_reports.append(processed_report)
-
-    master_report = None
-    for report in relevant_reports:
-        df = pd.read_csv(f"{get_report_path()}{report}", parse_dates=["Date"], date_parser=lambda x: datetime.strptime(x, "%Y%m%d") )
-        if isinstance(master_report, pd.DataFrame):
-            master_report = pd.concat([master_report, df])
-        else:
-            master_report = df
-    return master_report
+        name = f"{get_version_str()}_{name}"
+    matches = []
+    for file, entry in sorted(update_report_index(path).items()):
+        if f"{name}.csv" not in file:
+            continue
+        if start_date != None and entry["end"] != None and entry["end"] < pd.to_datetime(start_date).strftime("%Y-%m-%d"):
+            continue
+        if end_date != None and entry["start"] != None and entry["start"] > pd.to_datetime(end_date).strftime("%Y-%m-%d"):
+            continue
+        matches.append(entry)
+    return matches
+
+# Returns single DataFrame of all reports that match a specified name
+def load_reports(name, current_version_only = True, start_date = None, end_date = None, workers = DEFAULT_READ_WORKERS):
+    path = get_report_path()
+    reports = find_reports(name, current_version_only, start_date, end_date, path)
+    if len(reports) == 0:
+        return None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(lambda entry: read_processed_report(f"{path}{entry['file']}"), reports))
+    return pd.concat(frames)
 
 # Returens variant name
 def determine_variant(dimension):
@@ -79,6 +190,69 @@ def remove_outliers(df, col, quant=0.99):
     q_high = df[col].quantile(quant)
     return df[(df[col] < q_high) & (df[col] > q_low)]
 
+# Uniform sample of a stream of arrays without holding the stream in memory: every value gets a random key and
+# the `size` values with the smallest keys are kept. Update it with each chunk, then read `values`.
+def build_reservoir(size = DEFAULT_SAMPLE_SIZE, seed = 42):
+    return {
+        "size": size,
+        "rng": np.random.default_rng(seed),
+        "keys": np.empty(0),
+        "values": np.empty(0),
+        "count": 0,
+    }
+
+def update_reservoir(reservoir, values):
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    reservoir["count"] += values.shape[0]
+    keys = np.concatenate([reservoir["keys"], reservoir["rng"].random(values.shape[0])])
+    values = np.concatenate([reservoir["values"], values])
+    if keys.shape[0] > reservoir["size"]:
+        keep = np.argpartition(keys, reservoir["size"] - 1)[:reservoir["size"]]
+        keys, values = keys[keep], values[keep]
+    reservoir["keys"], reservoir["values"] = keys, values
+    return reservoir
+
+# Quantiles of everything passed to the reservoir, exact while it has seen no more than `size` values
+def reservoir_quantiles(reservoir, quantiles):
+    return np.quantile(reservoir["values"], quantiles)
+
+# In memory a random sample of rows is enough, the reservoir is only needed when the values arrive in chunks
+def approx_quantiles(values, quantiles, sample_size = DEFAULT_SAMPLE_SIZE, seed = 42):
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if values.shape[0] > sample_size:
+        values = values[np.random.default_rng(seed).integers(0, values.shape[0], sample_size)]
+    return np.quantile(values, quantiles)
+
+# `remove_outliers` with the bounds taken from a sample of the column rather than sorting all of it
+def remove_outliers_approx(df, col, quant=0.99, sample_size = DEFAULT_SAMPLE_SIZE):
+    q_low, q_high = approx_quantiles(df[col].to_numpy(), [1 - quant, quant], sample_size)
+    values = df[col].to_numpy()
+    return df[(values < q_high) & (values > q_low)]
+
+# Outlier filter for CSVs too large to load: one streaming pass to estimate the bounds from a reservoir sample,
+# a second to filter each chunk. Filtered chunks are appended to `output_path` when given, otherwise returned as one frame.
+def remove_outliers_chunked(path, col, quant=0.99, chunksize = DEFAULT_CHUNK_SIZE, sample_size = DEFAULT_SAMPLE_SIZE, output_path = None, **read_csv_kwargs):
+    reservoir = build_reservoir(sample_size)
+    for chunk in pd.read_csv(path, usecols=[col], chunksize=chunksize):
+        update_reservoir(reservoir, chunk[col].to_numpy())
+    q_low, q_high = reservoir_quantiles(reservoir, [1 - quant, quant])
+
+    filtered = []
+    first = True
+    for chunk in pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs):
+        values = chunk[col].to_numpy()
+        chunk = chunk[(values < q_high) & (values > q_low)]
+        if output_path != None:
+            chunk.to_csv(output_path, mode="w" if first else "a", header=first, index=False)
+            first = False
+        else:
+            filtered.append(chunk)
+    if output_path != None:
+        return output_path
+    return pd.concat(filtered)
+
 # Removes rows from DataFrame that contain lower than specified value in specified column
 def enforce_min_value(df, col, min_value = 0):
     return df[df[col] > min_value].copy()
@@ -97,12 +271,14 @@ def load_file_as_json(fp):
     json_file = json.load(file)
     return json_file
     
-def get_version_str():
-    events = load_file_as_json("../../config/events.json")
-    metrics = load_file_as_json("../../config/metrics.json")
-    segments = load_file_as_json("../../config/segments.json")
-    dimensions = load_file_as_json("../../config/dimensions.json")
-    boilerplate = load_file_as_json("../../config/boilerplate.json")
+# Read once per run, call `get_version_str.cache_clear()` if the config files change mid-run
+@lru_cache(maxsize=None)
+def get_version_str(config_path = "../../config/"):
+    events = load_file_as_json(f"{config_path}events.json")
+    metrics = load_file_as_json(f"{config_path}metrics.json")
+    segments = load_file_as_json(f"{config_path}segments.json")
+    dimensions = load_file_as_json(f"{config_path}dimensions.json")
+    boilerplate = load_file_as_json(f"{config_path}boilerplate.json")
 
     events_version = events["version"]
     dimensions_version = dimensions["version"]
@@ -0,0 +1,64 @@
+import os, re, sqlite3
+import pandas as pd
+
+DEFAULT_TABLE = "`project.dataset.table`"
+# Columns every aggregated row is keyed on, dimensions are added after these
+DEFAULT_KEYS = ["event_date", "optimisation_id", "optimisation_variant"]
+
+# Aggregate expression for a metric object, SUM(<name>) unless the metric has an "expression"
+def metric_expression(metric):
+    return metric.get("expression", f"SUM({metric['name']})")
+
+# Builds a query returning one row per key x dimension x day with every metric pre-aggregated.
+# The date range uses the same placeholders `get_data.process_query` fills in.
+def build_aggregate_query(metrics, dimensions=[], table=DEFAULT_TABLE, keys=DEFAULT_KEYS, date_column="event_date", where=None):
+    group_columns = keys + [dimension for dimension in dimensions if dimension not in keys]
+    metric_columns = []
+    for metric in metrics:
+        column = f"{metric_expression(metric)} AS {metric['name']}"
+        if column not in metric_columns:
+            metric_columns.append(column)
+    conditions = [f"{date_column} BETWEEN {{{{ @START_DATE }}}} AND {{{{ @END_DATE }}}}"]
+    if where != None:
+        conditions.append(where)
+
+    query = "SELECT\n"
+    query += ",\n".join(f"    {column}" for column in group_columns + metric_columns)
+    query += f"\nFROM {table}\nWHERE\n    "
+    query += "\n    AND ".join(conditions)
+    query += "\nGROUP BY\n"
+    query += ",\n".join(f"    {column}" for column in group_columns)
+    return query + "\n"
+
+# Saves a query where `get_data.update_local_data(query_name)` looks for it
+def write_query(query, query_name, query_dir="../sql/"):
+    if not os.path.exists(query_dir):
+        os.makedirs(query_dir)
+    with open(os.path.join(query_dir, query_name + ".sql"), "w") as file:
+        file.write(query)
+
+# Runs a generated query against `df` in an in-memory SQLite database standing in for the warehouse
+def run_local_query(query, df, start_date, end_date, table=DEFAULT_TABLE, date_column="event_date"):
+    local = df.copy()
+    local[date_column] = pd.to_datetime(local[date_column]).dt.strftime("%Y-%m-%d")
+    connection = sqlite3.connect(":memory:")
+    try:
+        local.to_sql("events", connection, index=False)
+        local_query = query.replace(table, "events")
+        if start_date != None and end_date != None:
+            local_query = local_query.replace("{{ @START_DATE }}", f"'{pd.to_datetime(start_date):%Y-%m-%d}'")
+            local_query = local_query.replace("{{ @END_DATE }}", f"'{pd.to_datetime(end_date):%Y-%m-%d}'")
+        # get_data.process_query quotes dates the BigQuery way, SQLite needs single quotes for literals
+        local_query = re.sub(r'"(\d{4}-\d{2}-\d{2})"', r"'\1'", local_query)
+        result = pd.read_sql_query(local_query, connection)
+    finally:
+        connection.close()
+    result[date_column] = pd.to_datetime(result[date_column])
+    return result
+
+# `get_data` runner backed by `run_local_query`, for running update_local_data offline
+def local_runner(df, table=DEFAULT_TABLE, date_column="event_date"):
+    def runner(query, name, start_date, end_date):
+        print(f"Running local query for {name}")
+        return run_local_query(query, df, start_date, end_date, table=table, date_column=date_column)
+    return runner
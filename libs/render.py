@@ -0,0 +1,210 @@
+import os, json, hashlib
+import pandas as pd
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import libs.instrument as instrument
+
+DEFAULT_WORKERS = os.cpu_count()
+VISUALISATION_DIR = "./visualisations/"
+# Chart name -> content hash for every chart rendered into a directory
+MANIFEST_NAME = "manifest.json"
+# Bump when the drawing code changes so cached charts are re-rendered
+RENDER_VERSION = 1
+# Rendered PNGs kept in memory, keyed by the chart's path so slide configs work unchanged
+IMAGE_REGISTRY = {}
+
+# Output path for a chart, the same for a given name and directory on every run
+def chart_path(name, directory=VISUALISATION_DIR):
+    return f"{directory}{name}.png"
+
+# Describes a single-KPI bar chart, arguments match `export.visualise`
+def build_chart_job(data, kpi, name, ylim=.8, fmt="%.2f%%", extra_title="", palette=None, directory=VISUALISATION_DIR):
+    return {
+        "kind": "bar",
+        "data": data[["Variant", kpi]].copy(),
+        "kpi": kpi,
+        "ylim": ylim,
+        "fmt": fmt,
+        "title": f"{kpi} {extra_title}",
+        "palette": palette,
+        "path": chart_path(name, directory),
+    }
+
+# Describes the Rate / Impact / Chance of being best chart built by `analysis.build_summary_job`
+def build_summary_chart_job(rate, imp, sig, name, palette, path):
+    return {
+        "kind": "summary",
+        "rate": rate,
+        "imp": imp,
+        "sig": sig,
+        "title": name,
+        "palette": palette,
+        "path": path,
+    }
+
+# Figure drawn through the object-oriented Agg API, it isn't registered with pyplot
+# so nothing is shared between charts and it's freed once it goes out of scope
+def create_figure(figsize):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+def draw_bar_chart(job):
+    import seaborn as sns
+    with sns.axes_style("darkgrid"), sns.plotting_context("notebook"):
+        fig = create_figure((8, 8))
+        ax = fig.add_subplot()
+        chart = sns.barplot(data=job["data"], x="Variant", y=job["kpi"], palette=job["palette"], ax=ax)
+        ylim = job["ylim"]
+        if isinstance(ylim, (float, int)):
+            chart.set_ylim(0, ylim)
+        elif isinstance(ylim, tuple):
+            chart.set_ylim(ylim[0], ylim[1])
+        chart.set_xlabel("")
+        chart.set_ylabel("")
+        chart.set_title(job["title"])
+        for container in chart.containers:
+            chart.bar_label(container, fmt=job["fmt"])
+        fig.tight_layout()
+    return fig
+
+def draw_summary_chart(job):
+    import seaborn as sns
+    with sns.axes_style("darkgrid"), sns.plotting_context("notebook"):
+        fig = create_figure((20, 15))
+        ax = fig.subplots(3, 1)
+        fig.suptitle(job["title"], fontsize=16)
+        rate_bp = sns.barplot(data=job["rate"], x="Metric", y="Rate", hue="optimisation_variant", palette=job["palette"], ax=ax[0])
+        imp_bp = sns.barplot(data=job["imp"], x="Metric", y="Impact", hue="optimisation_variant", palette=job["palette"], ax=ax[1])
+        sig_bp = sns.barplot(data=job["sig"], x="Metric", y="Significance", hue="optimisation_variant", palette=job["palette"], ax=ax[2])
+        ax[0].set_title("Rate", pad=10)
+        ax[1].set_title("Relative Impact", pad=10)
+        ax[2].set(ylim=(0, 100))
+        ax[2].set_title("Chance of being best", pad=10)
+        for bp in [imp_bp, sig_bp, rate_bp]:
+            bp.axhline(0, c="red")
+            for container in bp.containers:
+                bp.bar_label(container, fmt="%.2f%%")
+        fig.tight_layout()
+    return fig
+
+@instrument.timed()
+def draw_figure(job):
+    if job["kind"] == "summary":
+        return draw_summary_chart(job)
+    return draw_bar_chart(job)
+
+def save_figure(fig, path):
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    fig.savefig(path, format="png")
+
+def render_chart(job):
+    save_figure(draw_figure(job), job["path"])
+    return job["path"]
+
+@instrument.timed()
+def figure_to_png(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+def render_chart_to_png(job):
+    return figure_to_png(draw_figure(job))
+
+def register_image(path, png):
+    IMAGE_REGISTRY[path] = png
+
+def write_png(path, png):
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(png)
+
+# A registered image as a file-like object for `insert_picture`, or the path itself if it isn't registered
+def get_image(path, images=None):
+    if images == None:
+        images = IMAGE_REGISTRY
+    if path in images:
+        return BytesIO(images[path])
+    return path
+
+# Hash of everything that changes a chart's pixels: plotted data, KPI, limits, format, title and palette
+def chart_hash(job):
+    digest = hashlib.sha256(f"{RENDER_VERSION}".encode())
+    for key in sorted(job):
+        if key == "path":
+            continue
+        value = job[key]
+        digest.update(key.encode())
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr(list(value.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()
+
+def get_manifest_path(chart_path):
+    return os.path.join(os.path.dirname(chart_path), MANIFEST_NAME)
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+def save_manifest(path, manifest):
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+# Renders every job, across a process pool when `workers` > 1, and returns the output paths in job order.
+# With `cache`, charts whose PNG exists and whose hash matches the directory's manifest are not re-rendered.
+# With `in_memory`, PNGs are also kept in IMAGE_REGISTRY, and `to_disk=False` skips writing files (and the cache).
+@instrument.timed()
+def render_charts(jobs, workers=DEFAULT_WORKERS, cache=True, in_memory=False, to_disk=True):
+    if not to_disk:
+        cache = False
+        in_memory = True
+    pending = list(jobs)
+    if cache:
+        hashes = [chart_hash(job) for job in jobs]
+        manifests = {}
+        for job in jobs:
+            manifest_path = get_manifest_path(job["path"])
+            if manifest_path not in manifests:
+                manifests[manifest_path] = load_manifest(manifest_path)
+        pending = [
+            job for job, content_hash in zip(jobs, hashes)
+            if manifests[get_manifest_path(job["path"])].get(os.path.basename(job["path"])) != content_hash or not os.path.exists(job["path"])
+        ]
+
+    if workers == None or workers <= 1 or len(pending) <= 1:
+        pngs = [render_chart_to_png(job) for job in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pngs = list(pool.map(render_chart_to_png, pending))
+    for job, png in zip(pending, pngs):
+        if to_disk:
+            write_png(job["path"], png)
+        if in_memory:
+            register_image(job["path"], png)
+
+    if cache:
+        if in_memory:
+            # Charts served from the cache are loaded from disk into the registry
+            for job in jobs:
+                if job["path"] not in IMAGE_REGISTRY:
+                    with open(job["path"], "rb") as file:
+                        register_image(job["path"], file.read())
+        for job, content_hash in zip(jobs, hashes):
+            manifests[get_manifest_path(job["path"])][os.path.basename(job["path"])] = content_hash
+        for manifest_path, manifest in manifests.items():
+            save_manifest(manifest_path, manifest)
+    return [job["path"] for job in jobs]
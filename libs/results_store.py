@@ -0,0 +1,131 @@
+import os, sqlite3
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import libs.analysis as analysis
+
+DEFAULT_PATH = "./data/results.sqlite"
+# Rows for summaries without a segment column
+DEFAULT_SEGMENT = "All"
+# How long a writer waits for another process (e.g. another test in the runner's pool) to finish writing
+LOCK_TIMEOUT = 30
+# One row per test x segment x variant x metric x run date, so re-running a test on the same day replaces its rows
+COLUMNS = ["test_id", "segment", "variant", "metric", "run_date", "impressions", "conversions", "rate", "impact", "significance", "run_at"]
+KEY_COLUMNS = ["test_id", "segment", "variant", "metric", "run_date"]
+FILTER_COLUMNS = ["test_id", "segment", "variant", "metric"]
+
+def connect(path=DEFAULT_PATH):
+    directory = os.path.dirname(path)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        "test_id TEXT, segment TEXT, variant TEXT, metric TEXT, run_date TEXT, "
+        "impressions REAL, conversions REAL, rate REAL, impact REAL, significance REAL, run_at TEXT, "
+        "PRIMARY KEY (test_id, segment, variant, metric, run_date))"
+    )
+    # The primary key already covers lookups by test, these cover cross-test lookups by metric and by date
+    connection.execute("CREATE INDEX IF NOT EXISTS results_metric ON results (metric, run_date)")
+    connection.execute("CREATE INDEX IF NOT EXISTS results_run_date ON results (run_date)")
+    connection.commit()
+    return connection
+
+# Long frame of the store's columns from a `summarise_test` result, one row per segment x variant x metric.
+# The variant column is `optimisation_variant`, or `Variant` once renamed for the report.
+def melt_summary(summary, test_id, metrics, run_date=None, run_at=None, segment_column="segment"):
+    if run_at == None:
+        run_at = datetime.now()
+    if run_date == None:
+        run_date = run_at
+    variant_column = "optimisation_variant" if "optimisation_variant" in summary.columns else "Variant"
+    segments = summary[segment_column].astype(str).to_numpy() if segment_column in summary.columns else np.full(summary.shape[0], DEFAULT_SEGMENT)
+    display_names = {metric["name"]: metric["display_name"] for metric in metrics}
+    frames = []
+    for metric in metrics:
+        if metric["previous_step"] == None:
+            continue
+        columns = {
+            "impressions": display_names.get(metric["previous_step"], metric["previous_step"]),
+            "conversions": metric["display_name"],
+            "rate": analysis.get_rate_column(metric),
+            "impact": f"{metric['display_name']} Impact",
+            "significance": f"{metric['display_name']} Significance",
+        }
+        frame = pd.DataFrame({
+            "test_id": str(test_id),
+            "segment": segments,
+            "variant": summary[variant_column].astype(str).to_numpy(),
+            "metric": metric["display_name"],
+        })
+        for column, source in columns.items():
+            frame[column] = summary[source].to_numpy(dtype=float) if source in summary.columns else np.nan
+        frames.append(frame)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+    results = pd.concat(frames, ignore_index=True)
+    results["run_date"] = pd.to_datetime(run_date).strftime("%Y-%m-%d")
+    results["run_at"] = pd.to_datetime(run_at).isoformat(timespec="seconds")
+    return results[COLUMNS]
+
+# Upserts rows with the store's columns, replacing any with the same test, segment, variant, metric and run date
+def write_results(connection, results):
+    rows = results[COLUMNS].astype(object).where(results[COLUMNS].notna(), None).itertuples(index=False, name=None)
+    with connection:
+        connection.executemany(f"INSERT OR REPLACE INTO results ({', '.join(COLUMNS)}) VALUES ({', '.join('?' for _ in COLUMNS)})", rows)
+    return results.shape[0]
+
+def store_summary(summary, test_id, metrics, path=DEFAULT_PATH, run_date=None, segment_column="segment"):
+    results = melt_summary(summary, test_id, metrics, run_date=run_date, segment_column=segment_column)
+    connection = connect(path)
+    try:
+        return write_results(connection, results)
+    finally:
+        connection.close()
+
+# Results filtered in SQL, so only the matching rows are loaded. Test, segment, variant and metric take a value or a list,
+# dates are inclusive run dates and `min_impact` / `min_significance` are percentages as in `summarise_test`.
+# With `latest_only`, only each test's most recent run is returned.
+def query_results(path=DEFAULT_PATH, test_id=None, segment=None, variant=None, metric=None, start_date=None, end_date=None, min_impact=None, min_significance=None, latest_only=False):
+    conditions = []
+    params = []
+    for column, value in zip(FILTER_COLUMNS, [test_id, segment, variant, metric]):
+        if value == None:
+            continue
+        values = [value] if isinstance(value, str) else list(value)
+        conditions.append(f"{column} IN ({', '.join('?' for _ in values)})")
+        params += [str(v) for v in values]
+    if start_date != None:
+        conditions.append("run_date >= ?")
+        params.append(pd.to_datetime(start_date).strftime("%Y-%m-%d"))
+    if end_date != None:
+        conditions.append("run_date <= ?")
+        params.append(pd.to_datetime(end_date).strftime("%Y-%m-%d"))
+    if min_impact != None:
+        conditions.append("impact >= ?")
+        params.append(float(min_impact))
+    if min_significance != None:
+        conditions.append("significance >= ?")
+        params.append(float(min_significance))
+    if latest_only:
+        conditions.append("run_date = (SELECT MAX(latest.run_date) FROM results AS latest WHERE latest.test_id = results.test_id)")
+    query = f"SELECT {', '.join(COLUMNS)} FROM results"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY test_id, run_date, metric, segment, variant"
+    connection = connect(path)
+    try:
+        results = pd.read_sql_query(query, connection, params=params)
+    finally:
+        connection.close()
+    results["run_date"] = pd.to_datetime(results["run_date"])
+    return results
+
+# Test IDs in the store with the dates they were run on
+def list_tests(path=DEFAULT_PATH):
+    connection = connect(path)
+    try:
+        return pd.read_sql_query("SELECT test_id, MIN(run_date) AS first_run, MAX(run_date) AS last_run, COUNT(DISTINCT run_date) AS runs FROM results GROUP BY test_id ORDER BY test_id", connection)
+    finally:
+        connection.close()
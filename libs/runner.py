@@ -0,0 +1,290 @@
+import os, sys, json, time, argparse, traceback
+import pandas as pd
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import libs.utils as utils
+import libs.get_data as get_data
+import libs.segmentation as segmentation
+import libs.analysis as analysis
+import libs.export as export
+import libs.render as render
+import libs.generate as generate
+import libs.instrument as instrument
+import libs.results_store as results_store
+
+DEFAULT_WORKERS = os.cpu_count()
+# Charts are rendered in the test's own process by default, the pool is already spread across tests
+DEFAULT_CHART_WORKERS = 1
+TESTS_DIR = "./"
+CONFIG_NAME = "test_config.json"
+# Segmented data is kept per day, the unit revenue metrics are bootstrapped by
+DAY_COLUMN = "event_date"
+STAGES = ["update_local_data", "segment_data", "summarise_test", "store_results", "render_charts", "generate_report"]
+
+# Everything the runner needs to refresh one test's report. `directory` is the test's working directory
+# (where the notebooks would be run from, so `./data/` and `../sql/` resolve the same way).
+def build_test_config(id, start_date, query="SQL-Query", end_date=None, directory=".", storage="csv", shard_days=None, metrics=analysis.DEFAULT_METRICS, segments=segmentation.DEFAULT_SEGMENTS, control_name=None, refresh=True, notes={}):
+    return {
+        "id": id,
+        "start_date": start_date,
+        "end_date": end_date,
+        "query": query,
+        "directory": directory,
+        "storage": storage,
+        "shard_days": shard_days,
+        "metrics": metrics,
+        "segments": segments,
+        "control_name": control_name,
+        "refresh": refresh,
+        "notes": notes,
+    }
+
+# Accepts a path to a config JSON, or a test ID found at `<tests_dir>/<id>/test_config.json`.
+# A relative `directory` is resolved against the config file's location.
+def load_test_config(test, tests_dir=TESTS_DIR):
+    path = test if os.path.isfile(test) else os.path.join(tests_dir, test, CONFIG_NAME)
+    with open(path, "r") as file:
+        loaded = json.load(file)
+    config = build_test_config(loaded["id"], loaded["start_date"])
+    config.update(loaded)
+    config["directory"] = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(path)), config["directory"]))
+    return config
+
+@contextmanager
+def timed_stage(timings, stage):
+    start = time.perf_counter()
+    try:
+        with instrument.stage(f"runner.{stage}"):
+            yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+def load_test_data(config):
+    path = f"./data/{config['query']}"
+    if config["storage"] == "parquet":
+        return utils.load_partitioned_df(path, start_date=config["start_date"], end_date=config["end_date"])
+    dimensions = list(dict.fromkeys(column for segment in config["segments"] for column in segment["filters"]))
+    data = utils.load_bq_df_chunked(path + ".csv", dimensions=dimensions)
+    data = data[data.event_date >= pd.to_datetime(config["start_date"])]
+    if config["end_date"] != None:
+        data = data[data.event_date <= pd.to_datetime(config["end_date"])]
+    return data
+
+# Metrics whose column is in the data and whose `previous_step` is itself a kept metric. Dropping a metric can orphan
+# the metrics built on it, so this repeats until nothing else is dropped. Dropped metrics are reported, and it fails
+# when no metric with a `previous_step` is left, as the report would have no metric slides.
+def get_available_metrics(metrics, columns):
+    kept = [metric for metric in metrics if metric["name"] in columns]
+    while True:
+        names = set(metric["name"] for metric in kept)
+        available = [metric for metric in kept if metric["previous_step"] == None or metric["previous_step"] in names]
+        if len(available) == len(kept):
+            break
+        kept = available
+    dropped = [metric for metric in metrics if metric not in available]
+    if len(dropped) > 0:
+        utils.print_error(f"Skipping metrics missing from the data or whose previous step is: {', '.join(metric['name'] for metric in dropped)}")
+    if not any(metric["previous_step"] != None for metric in available):
+        raise ValueError(f"No metric can be reported from the data's columns: {', '.join(columns)}")
+    return available
+
+# Adds the control's totals from the same segment as `control_<metric>` columns, as `summarise_test` expects
+def add_control_columns(data, metric_names, control_name, keys=["segment"]):
+    control_data = data[data.optimisation_variant == control_name][keys + metric_names]
+    control_data.columns = keys + [f"control_{metric}" for metric in metric_names]
+    return pd.merge(left=data, right=control_data, how="left", on=keys)
+
+# `segmented` can be broken down by day as well (`segment_data(by=["event_date"])`), so revenue metrics are bootstrapped.
+# Significance the bootstrap couldn't compute is left as NaN rather than filled.
+def summarise(segmented, metrics, control_name=None):
+    metric_names = list(dict.fromkeys(metric["name"] for metric in metrics))
+    if control_name == None:
+        # Same default as the analysis notebook: the first variant alphabetically, i.e. Control
+        control_name = segmented.optimisation_variant.sort_values().values[0]
+    keys = ["segment"] + ([DAY_COLUMN] if DAY_COLUMN in segmented.columns else [])
+    data = add_control_columns(segmented, metric_names, control_name, keys=keys)
+    summary = analysis.summarise_test(data=data, metrics=metrics, dimensions=["segment"], control_name=control_name)
+    summary.fillna({column: 0 for column in summary.columns if not column.endswith(" Significance")}, inplace=True)
+    summary["optimisation_variant"] = summary.optimisation_variant.str.replace("_", " ", regex=True).str.capitalize()
+    return summary.rename(columns={"optimisation_variant": "Variant"})
+
+# Title and notes slides for a metric, then a chart and table slide per segment.
+# The chart jobs are appended to `chart_jobs` so every chart in the report is rendered together.
+def build_metric_section(summary, metric, metrics, segments, notes, chart_jobs):
+    is_revenue = "revenue" in metric["name"].lower()
+    rate = analysis.get_rate_column(metric)
+    previous = next((m["display_name"] for m in metrics if m["name"] == metric["previous_step"]), metric["previous_step"])
+    columns = ["Variant", previous, metric["display_name"], rate, f"{metric['display_name']} Impact", f"{metric['display_name']} Significance"]
+    rename_map = {f"{metric['display_name']} Impact": "Impact", f"{metric['display_name']} Significance": "Chance of being best"}
+    format_map = {
+        previous: export.format_int,
+        metric["display_name"]: export.format_rev if is_revenue else export.format_int,
+        rate: export.format_rev if is_revenue else export.format_perc,
+        "Impact": export.format_perc,
+        "Chance of being best": export.format_perc,
+    }
+
+    slides = [export.generate_title_slide(title=rate, subtitle=metric["display_name"])]
+    if metric["name"] in notes:
+        slides.append(export.generate_notes_slide(title=rate, content=notes[metric["name"]]))
+    for segment in segments:
+        table = summary[summary.segment == segment["display_name"]][columns].rename(columns=rename_map)
+        if table.shape[0] == 0:
+            continue
+        name = f"{segment['name']}-{rate}"
+        ylim = table[rate].max() * 1.2
+        chart_jobs.append(export.build_visualisation_job(table, rate, name, ylim=ylim if ylim > 0 else .8, fmt="£%.2f" if is_revenue else "%.2f%%", extra_title=f"- {segment['display_name']}"))
+        slides.append(export.generate_metric_slide(
+            title=rate,
+            segment=segment["display_name"],
+            data=export.format_series(table, format_map=format_map, transpose=True),
+            image_path=render.chart_path(name),
+            footer=f"Segment definition: {segment['definition']}",
+        ))
+    return slides
+
+def build_report_info_slide(data, start, end, fmt="%d %B %Y"):
+    device_report = utils.create_device_report(data)
+    points = device_report["device_category"].astype(str).str.capitalize() + " - "
+    points += device_report["% of total"].apply(lambda x: f"{x:.2f}%")
+    points += device_report["impressions"].apply(lambda x: f" ({x:,.0f} Impressions)")
+    content = {
+        "title": "Device Breakdown",
+        "points": points.tolist(),
+        "start": pd.to_datetime(start).strftime(fmt),
+        "end": pd.to_datetime(end).strftime(fmt),
+    }
+    return export.generate_report_info_slide(title="Notes", content=content)
+
+# Runs every stage for one test from its own directory and returns its per-stage timings.
+# Failures are caught and reported in the result so one broken test doesn't stop the batch.
+# With `profile`, the test's `instrument` stats and trace events are returned in the result under "instrument".
+# With `results_db`, the summary is upserted into that `results_store` database (an absolute path, as the runner changes directory).
+def run_test(config, chart_workers=DEFAULT_CHART_WORKERS, profile=False, results_db=None):
+    result = {"id": config["id"], "status": "ok", "timings": {}, "report": None, "error": None}
+    if profile:
+        instrument.reset()
+        instrument.enable()
+    timings = result["timings"]
+    cwd = os.getcwd()
+    # Chart paths are relative to the test directory, so images registered by an earlier test can't be reused
+    render.IMAGE_REGISTRY.clear()
+    start = time.perf_counter()
+    try:
+        os.chdir(config["directory"])
+        metrics = config["metrics"]
+        with timed_stage(timings, "update_local_data"):
+            if config["refresh"]:
+                get_data.update_local_data(config["query"], TEST_start_date=config["start_date"], TEST_ID=config["id"], storage=config["storage"], shard_days=config["shard_days"])
+            data = load_test_data(config)
+
+        with timed_stage(timings, "segment_data"):
+            metrics = get_available_metrics(metrics, data.columns)
+            metric_names = list(dict.fromkeys(metric["name"] for metric in metrics))
+            segmented = segmentation.segment_data(data, config["segments"], metrics=metric_names, by=[DAY_COLUMN] if DAY_COLUMN in data.columns else [])
+
+        with timed_stage(timings, "summarise_test"):
+            summary = summarise(segmented, metrics, control_name=config["control_name"])
+
+        if results_db != None:
+            with timed_stage(timings, "store_results"):
+                results_store.store_summary(summary, config["id"], metrics, path=results_db)
+
+        with timed_stage(timings, "render_charts"):
+            chart_jobs = []
+            slides = [export.generate_divider_slide("Report Information")]
+            if "device_category" in data.columns and "impressions" in data.columns:
+                slides.append(build_report_info_slide(data, data.event_date.min(), data.event_date.max()))
+            slides.append(export.generate_divider_slide("Metrics"))
+            for metric in metrics:
+                if metric["previous_step"] != None:
+                    slides += build_metric_section(summary, metric, metrics, config["segments"], config["notes"], chart_jobs)
+            export.visualise_all(chart_jobs, workers=chart_workers, cache=True, in_memory=True)
+
+        with timed_stage(timings, "generate_report"):
+            generate.generate_report(export.output_metric_to_config(slides, id=config["id"]))
+            result["report"] = os.path.join(config["directory"], f"{config['id']} - Post-Test Data Report.pptx")
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+    timings["total"] = time.perf_counter() - start
+    if profile:
+        instrument.disable()
+        result["instrument"] = instrument.collect()
+    return result
+
+def print_result(result):
+    stages = ", ".join(f"{stage} {result['timings'][stage]:.2f}s" for stage in STAGES if stage in result["timings"])
+    if result["status"] == "ok":
+        utils.print_success(f"{result['id']}: done in {result['timings']['total']:.2f}s ({stages})")
+    else:
+        utils.print_error(f"{result['id']}: failed after {result['timings']['total']:.2f}s ({stages}) - {result['error']}")
+
+# Runs each test in its own worker process (the runner changes directory per test, so tests never share a process
+# at the same time) and prints each result as it finishes. Results are returned in config order.
+def run_tests(configs, workers=DEFAULT_WORKERS, chart_workers=DEFAULT_CHART_WORKERS, profile=False, results_db=None):
+    if workers == None or workers <= 1 or len(configs) <= 1:
+        results = []
+        for config in configs:
+            results.append(run_test(config, chart_workers, profile, results_db))
+            print_result(results[-1])
+        return results
+    results = [None] * len(configs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_test, config, chart_workers, profile, results_db): i for i, config in enumerate(configs)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            print_result(results[futures[future]])
+    return results
+
+def print_summary(results, wall_time):
+    print(f"\n{'test':<16}" + "".join(f"{stage:>20}" for stage in STAGES) + f"{'total':>12}")
+    for result in results:
+        stages = [f"{result['timings'][stage]:.2f}s" if stage in result["timings"] else "-" for stage in STAGES]
+        print(f"{result['id']:<16}" + "".join(f"{stage:>20}" for stage in stages) + f"{result['timings']['total']:>11.2f}s")
+    failed = [result["id"] for result in results if result["status"] != "ok"]
+    print(f"\n{len(results) - len(failed)}/{len(results)} tests refreshed in {wall_time:.2f}s")
+    if len(failed) > 0:
+        utils.print_error(f"Failed: {', '.join(failed)}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Refresh the data, analysis, charts and report for a batch of tests.")
+    parser.add_argument("tests", nargs="+", help=f"test config JSON files, or test IDs found at <tests-dir>/<id>/{CONFIG_NAME}")
+    parser.add_argument("--tests-dir", default=TESTS_DIR, help="directory containing one folder per test ID")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="tests run at the same time")
+    parser.add_argument("--chart-workers", type=int, default=DEFAULT_CHART_WORKERS, help="chart rendering processes per test")
+    parser.add_argument("--no-refresh", action="store_true", help="use the local data as it is, without querying for new days")
+    parser.add_argument("--results", default=None, help="write the per-test results and timings to this JSON file")
+    parser.add_argument("--results-db", default=None, help="upsert every test's summary into this results database (see libs/results_store.py)")
+    parser.add_argument("--profile", default=None, help="record per-stage time, calls and peak memory and write profile.json and trace.json (Chrome trace) to this directory")
+    args = parser.parse_args(argv)
+
+    configs = [load_test_config(test, args.tests_dir) for test in args.tests]
+    if args.no_refresh:
+        for config in configs:
+            config["refresh"] = False
+    start = time.perf_counter()
+    results_db = os.path.abspath(args.results_db) if args.results_db != None else None
+    results = run_tests(configs, workers=args.workers, chart_workers=args.chart_workers, profile=args.profile != None, results_db=results_db)
+    print_summary(results, time.perf_counter() - start)
+    if args.profile != None:
+        instrument.reset()
+        for result in results:
+            instrument.merge(result.pop("instrument"))
+        if not os.path.exists(args.profile):
+            os.makedirs(args.profile)
+        print()
+        instrument.print_summary()
+        instrument.write_summary(os.path.join(args.profile, "profile.json"))
+        instrument.write_chrome_trace(os.path.join(args.profile, "trace.json"))
+    if args.results != None:
+        with open(args.results, "w") as file:
+            json.dump(results, file, indent=2)
+    return 0 if all(result["status"] == "ok" for result in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
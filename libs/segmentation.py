@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Filters map a dimension column to a value, a list of values or a callable returning a boolean mask.
+# An empty filter dict matches every row.
+def build_segment_object(name, display_name, filters={}, definition=""):
+    return {
+        "name": name,
+        "display_name": display_name,
+        "filters": filters,
+        "definition": definition,
+    }
+
+# Every device other than mobile, as `processing.ipynb` defines desktop & tablet users. A module-level function
+# rather than a lambda so segments can be sent to the runner's worker processes.
+def not_mobile(device_category):
+    return device_category != "mobile"
+
+DEFAULT_SEGMENTS = [
+    build_segment_object("all_users", "All Users", {}, "All users who saw the test at least once."),
+    build_segment_object("desktop_tablet_users", "Desktop & Tablet Users", {"device_category": not_mobile}, "Desktop and Tablet users who saw the test at least once"),
+    build_segment_object("mobile_users", "Mobile Users", {"device_category": "mobile"}, "Mobile users who saw the test at least once"),
+]
+
+# Boolean mask of the rows in `df` that match a segment's filters
+def segment_mask(df, filters):
+    mask = np.ones(df.shape[0], dtype=bool)
+    for column, condition in filters.items():
+        if callable(condition):
+            mask &= np.asarray(condition(df[column]), dtype=bool)
+        elif isinstance(condition, (list, tuple, set)):
+            mask &= df[column].isin(condition).to_numpy()
+        else:
+            mask &= (df[column] == condition).to_numpy()
+    return mask
+
+# Aggregates every segment x variant in one grouped pass over `data`.
+# Rows are summed once into the finest cube (variant x every dimension used by a filter),
+# then each segment is rolled up from the cube rows it matches.
+# Columns in `by` (e.g. "event_date") are kept as well, giving one row per segment x variant x `by` values.
+def segment_data(data, segments=DEFAULT_SEGMENTS, metrics=None, variant_column="optimisation_variant", by=[]):
+    dimensions = [column for column in dict.fromkeys(column for segment in segments for column in segment["filters"]) if column not in by]
+    if metrics == None:
+        metrics = [column for column in data.select_dtypes("number").columns if column not in dimensions + by]
+    keys = [variant_column] + by
+    cube = data.groupby(keys + dimensions, observed=True, sort=False)[metrics].sum().reset_index()
+
+    if len(by) == 0:
+        group_codes, groups = pd.factorize(cube[variant_column], sort=True)
+        groups = pd.DataFrame({variant_column: groups})
+    else:
+        group_codes, groups = pd.MultiIndex.from_frame(cube[keys]).factorize(sort=True)
+        groups = pd.DataFrame(list(groups), columns=keys)
+    membership = np.vstack([segment_mask(cube, segment["filters"]) for segment in segments]).astype(float)
+    one_hot = np.eye(len(groups))[group_codes]
+    totals = np.einsum("sr,rv,rm->svm", membership, one_hot, cube[metrics].to_numpy(dtype=float), optimize=True)
+    has_rows = (membership @ one_hot).ravel() > 0
+
+    segmented = pd.DataFrame(totals.reshape(-1, len(metrics)), columns=metrics)
+    for metric in metrics:
+        if pd.api.types.is_integer_dtype(cube[metric]):
+            segmented[metric] = segmented[metric].round().astype(cube[metric].dtype)
+    for position, key in enumerate(keys):
+        segmented.insert(position, key, np.tile(groups[key].to_numpy(), len(segments)))
+    segmented.insert(0, "segment", np.repeat([segment["display_name"] for segment in segments], len(groups)))
+    return segmented[has_rows].reset_index(drop=True)
+
+# Splits the output of `segment_data` into one DataFrame per segment, keyed by segment name
+def split_segments(segmented, segments=DEFAULT_SEGMENTS):
+    return {
+        segment["name"]: segmented[segmented.segment == segment["display_name"]].reset_index(drop=True)
+        for segment in segments
+    }
+
+def output_segments_to_csv(segmented, segments=DEFAULT_SEGMENTS, output_dir="./data/segmented"):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for name, segment in split_segments(segmented, segments).items():
+        segment.to_csv(f"{output_dir}/{name}.csv")
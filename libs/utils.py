@@ -1,6 +1,32 @@
+import os
 import pandas as pd
 from datetime import datetime
 
+# Directory name prefix for each day's partition in a Parquet store
+DATE_PARTITION_PREFIX = "event_date="
+
+# Declared dtypes for BigQuery exports, columns that aren't listed are inferred
+BQ_SCHEMA = {
+    "optimisation_id": "category",
+    "optimisation_variant": "category",
+    "device_category": "category",
+    "impressions": "int64",
+    "page_views": "int64",
+    "view_search_results": "int64",
+    "view_item_lists": "int64",
+    "view_items": "int64",
+    "add_to_carts": "int64",
+    "view_carts": "int64",
+    "select_fulfillment": "int64",
+    "select_payment": "int64",
+    "purchases": "int64",
+    "transaction_revenue": "float64",
+}
+BQ_KEYS = ["event_date", "optimisation_id", "optimisation_variant"]
+DEFAULT_CHUNK_SIZE = 500000
+# Number of aggregated chunks held before they're combined
+CHUNKS_PER_COMBINE = 16
+
 def print_error(msg):
     print(f"\033[93m{msg}")
 
@@ -12,12 +38,52 @@ def status(df, n=5):
     return df.head(n)
 
 def load_bq_df(path, date=True):
+    if os.path.isdir(path):
+        return load_partitioned_df(path)
     if date:
         data = pd.read_csv(path, parse_dates=["event_date"], date_parser=pd.to_datetime, index_col="Unnamed: 0", dtype=str)
     else:
         data = pd.read_csv(path, index_col="Unnamed: 0")
     return data
 
+# Streams a BigQuery export in chunks with a typed schema, aggregating each chunk to variant x dimension x day
+# as it's read so peak memory is bounded by the chunk size rather than the file size.
+# Integer counters are read as floats, so NULL or empty values load, and cast back once filled with 0.
+def load_bq_df_chunked(path, dimensions=["device_category"], chunksize=DEFAULT_CHUNK_SIZE, schema=BQ_SCHEMA):
+    counters = [column for column, dtype in schema.items() if dtype == "int64"]
+    read_schema = {column: "float64" if column in counters else dtype for column, dtype in schema.items()}
+    reader = pd.read_csv(path, chunksize=chunksize, dtype=read_schema, parse_dates=["event_date"], usecols=lambda column: column != "Unnamed: 0")
+    keys = None
+    summary = None
+    partials = []
+    for chunk in reader:
+        if keys == None:
+            keys = [key for key in BQ_KEYS + dimensions if key in chunk.columns]
+            counters = [column for column in counters if column in chunk.columns]
+        chunk[counters] = chunk[counters].fillna(0).astype("int64")
+        partials.append(chunk.groupby(keys, observed=True, sort=False).sum(numeric_only=True))
+        if len(partials) >= CHUNKS_PER_COMBINE:
+            summary = pd.concat(partials).groupby(level=keys, observed=True, sort=False).sum()
+            partials = [summary]
+    if len(partials) == 0:
+        return pd.DataFrame(columns=[column for column in BQ_KEYS + dimensions])
+    summary = pd.concat(partials).groupby(level=keys, observed=True).sum().reset_index()
+    for key in keys:
+        if schema.get(key) == "category":
+            summary[key] = summary[key].astype("category")
+    return summary
+
+# Loads a Parquet store written by `get_data.update_local_data`, optionally only the partitions between two dates
+def load_partitioned_df(path, start_date=None, end_date=None):
+    filters = []
+    if start_date != None:
+        filters.append(("event_date", ">=", pd.to_datetime(start_date).strftime("%Y-%m-%d")))
+    if end_date != None:
+        filters.append(("event_date", "<=", pd.to_datetime(end_date).strftime("%Y-%m-%d")))
+    data = pd.read_parquet(path, filters=filters if len(filters) > 0 else None, partitioning="hive")
+    data["event_date"] = pd.to_datetime(data["event_date"].astype(str))
+    return data
+
 def create_device_report(df, metric = "impressions", device_col = "device_category", start="2000-01-01", end="2000-01-01"):
     group = df[[device_col, metric]].groupby(device_col).sum()
     group["% of total"] = group[metric].apply(lambda x: (x / group[metric].sum()) * 100)
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+import libs.analysis as analysis
+
+METRICS = [
+    analysis.build_metric_object(0, "impressions", "Impressions", None),
+    analysis.build_metric_object(1, "add_to_carts", "Add to cart rate", "impressions"),
+    analysis.build_metric_object(2, "purchases", "Purchases", "add_to_carts"),
+]
+COUNTS = ["impressions", "add_to_carts", "purchases"]
+TOLERANCE = 1e-9
+
+# Several rows per variant (one per segment and device), with a segment where one variant never converts
+def build_data(seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for variant in ["Control", "Variation 1", "Variation 2"]:
+        for segment in ["A", "B", "C"]:
+            for device in ["mobile", "desktop"]:
+                impressions = int(rng.integers(2000, 10000))
+                add_to_carts = int(impressions * rng.uniform(0.05, 0.15))
+                purchases = 0 if (segment, variant) == ("C", "Variation 2") else int(add_to_carts * rng.uniform(0.1, 0.3))
+                rows.append({"optimisation_variant": variant, "segment": segment, "device_category": device, "impressions": impressions, "add_to_carts": add_to_carts, "purchases": purchases})
+    data = pd.DataFrame(rows)
+    for column in COUNTS:
+        data[f"control_{column}"] = 0
+    return data
+
+# The per-row loop `summarise_test` ran before `bayes_batch`
+def reference_scores(summary, metric):
+    return [analysis.bayes(summary, impressions=metric["previous_step"], goal=metric["name"], variant=variant) for variant in summary.optimisation_variant]
+
+def test_bayes_batch_matches_bayes_pooled():
+    summary = build_data().groupby(["optimisation_variant", "segment"], as_index=False)[COUNTS].sum()
+    sig = analysis.bayes_batch(summary, METRICS)
+    for metric in METRICS[1:]:
+        scores = sig[sig.metric == metric["display_name"]]
+        expected = reference_scores(summary, metric)
+        assert np.allclose(scores["Impact"], [score["Impact"] for score in expected], rtol=0, atol=TOLERANCE)
+        assert np.allclose(scores["Chance of being best"], [score["Chance of being best"] for score in expected], rtol=0, atol=TOLERANCE)
+
+def test_summarise_test_ungrouped_matches_bayes():
+    data = build_data(1)
+    result = analysis.summarise_test(data=data, metrics=METRICS, dimensions=["segment"], grouped=False)
+    summary = data.groupby(["optimisation_variant", "segment"], as_index=False)[COUNTS].sum()
+    for metric in METRICS[1:]:
+        expected = reference_scores(summary, metric)
+        assert np.allclose(result[f"{metric['display_name']} Impact"], [score["Impact"] for score in expected], rtol=0, atol=TOLERANCE)
+        assert np.allclose(result[f"{metric['display_name']} Significance"], [score["Chance of being best"] for score in expected], rtol=0, atol=TOLERANCE)
+
+# Grouped mode scores every row against the control of its own segment, as `bayes()` on that segment alone
+def test_summarise_test_grouped_matches_bayes_per_segment():
+    data = build_data(2)
+    result = analysis.summarise_test(data=data, metrics=METRICS, dimensions=["segment"])
+    for segment in data.segment.unique():
+        rows = result[result.segment == segment]
+        segment_summary = data[data.segment == segment].groupby("optimisation_variant", as_index=False)[COUNTS].sum()
+        for metric in METRICS[1:]:
+            expected = {score["variant"]: score for score in reference_scores(segment_summary, metric)}
+            assert np.allclose(rows[f"{metric['display_name']} Impact"], [expected[variant]["Impact"] for variant in rows.optimisation_variant], rtol=0, atol=TOLERANCE)
+            assert np.allclose(rows[f"{metric['display_name']} Significance"], [expected[variant]["Chance of being best"] for variant in rows.optimisation_variant], rtol=0, atol=TOLERANCE)
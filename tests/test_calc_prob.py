@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from scipy.stats import beta
+
+from libs.calc_prob import g, g_batch, g_fast, calc_prob_between, calc_prob_between_fast, APPROX_THRESHOLD
+
+# The series is exact, so below the threshold the batch only differs from `g` by floating point error
+EXACT_TOLERANCE = 1e-9
+# Error allowed from the normal approximation above the threshold
+APPROX_TOLERANCE = 1e-3
+
+def reference(a, b, c, d):
+    return np.array([g(*params) for params in zip(a, b, c, d)])
+
+def random_params(rng, size, low=1, high=2000):
+    return [rng.integers(low, high, size).astype(float) for _ in range(4)]
+
+def test_random_integer_parameters():
+    rng = np.random.default_rng(0)
+    a, b, c, d = random_params(rng, 200)
+    assert np.allclose(g_batch(a, b, c, d), reference(a, b, c, d), rtol=0, atol=EXACT_TOLERANCE)
+
+def test_conversion_like_parameters():
+    rng = np.random.default_rng(1)
+    impressions = rng.integers(1000, 20000, (2, 100))
+    conversions = (impressions * rng.uniform(0.01, 0.1, (2, 100))).astype(int)
+    a, c = conversions + 1.0
+    b, d = impressions - conversions + 1.0
+    assert np.allclose(g_batch(a, b, c, d), reference(a, b, c, d), rtol=0, atol=EXACT_TOLERANCE)
+
+# Each cell is rotated so the series runs over its smallest parameter, make each one the smallest in turn
+@pytest.mark.parametrize("smallest", [0, 1, 2, 3])
+def test_rotations(smallest):
+    rng = np.random.default_rng(2 + smallest)
+    params = random_params(rng, 50, low=50, high=2000)
+    params[smallest] = rng.integers(1, 50, 50).astype(float)
+    assert np.allclose(g_batch(*params), reference(*params), rtol=0, atol=EXACT_TOLERANCE)
+
+# Non-positive parameters (e.g. revenue, or page views above impressions) aren't a Beta distribution
+def test_invalid_parameters_are_nan():
+    a = np.array([1.0, 10.0, 0.0, 5.0, np.nan, 5.0])
+    b = np.array([0.0, -40.0, 3.0, 5.0, 5.0, 5.0])
+    c = np.array([1.0, 10.0, 3.0, -1.0, 5.0, 5.0])
+    d = np.array([1.0, 20.0, 3.0, 5.0, 5.0, 5.0])
+    result = g_batch(a, b, c, d)
+    assert np.isnan(result[:5]).all()
+    assert result[5] == pytest.approx(g(5.0, 5.0, 5.0, 5.0), abs=EXACT_TOLERANCE)
+    assert np.isnan(g_fast(1, 0, 1, 1))
+
+def test_below_approx_threshold():
+    rng = np.random.default_rng(7)
+    a = rng.integers(APPROX_THRESHOLD // 2, APPROX_THRESHOLD, 10).astype(float)
+    c = rng.integers(APPROX_THRESHOLD // 2, APPROX_THRESHOLD, 10).astype(float)
+    # One parameter at the threshold keeps the cell on the exact series
+    b = np.full(10, float(APPROX_THRESHOLD))
+    d = a + b - c
+    assert np.allclose(g_batch(a, b, c, d), reference(a, b, c, d), rtol=0, atol=EXACT_TOLERANCE)
+
+def test_above_approx_threshold():
+    rng = np.random.default_rng(8)
+    impressions = rng.integers(3 * APPROX_THRESHOLD, 5 * APPROX_THRESHOLD, (2, 10))
+    rate = rng.uniform(0.4, 0.5, 10)
+    conversions = (impressions * rate * rng.uniform(0.995, 1.005, (2, 10))).astype(int)
+    a, c = conversions.astype(float)
+    b, d = (impressions - conversions).astype(float)
+    assert (np.stack([a, b, c, d]) > APPROX_THRESHOLD).all()
+    assert np.allclose(g_batch(a, b, c, d), reference(a, b, c, d), rtol=0, atol=APPROX_TOLERANCE)
+
+def test_mixed_batch_matches_single_cells():
+    rng = np.random.default_rng(9)
+    small = random_params(rng, 5)
+    large = [rng.integers(APPROX_THRESHOLD + 1, 2 * APPROX_THRESHOLD, 5).astype(float) for _ in range(4)]
+    params = [np.concatenate([s, l]) for s, l in zip(small, large)]
+    batch = g_batch(*params)
+    assert np.array_equal(batch, [g_fast(*cell) for cell in zip(*params)])
+
+def test_calc_prob_between_fast():
+    rng = np.random.default_rng(10)
+    for a, b, c, d in zip(*random_params(rng, 20)):
+        beta1, beta2 = beta(a, b), beta(c, d)
+        assert calc_prob_between_fast(beta1, beta2) == pytest.approx(calc_prob_between(beta1, beta2), abs=EXACT_TOLERANCE)
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from libs.export import format_int, format_float, format_perc, format_rev, format_perc_to_ratio, format_column, FUNCTION_FORMATS
+
+# Edge cases for the vectorised formatting: signs, zeros, half-way rounding, long integer parts and non-finite values
+EDGE_VALUES = [
+    0.0, -0.0, 0.004, -0.004, 0.005, -0.005, 0.125, -0.125, 0.375, 2.5, -2.5, 3.5, 0.5, -0.5, 1.005, 2.675,
+    999.995, -999.995, 999.5, 1000.0, -1000.0, 12345.678, -12345.678, 999999.5, 1234567.891,
+    1e15, -1e15, 1.5e15, 123456789012345678.0, 1e20, -1e21,
+    np.nan, np.inf, -np.inf,
+]
+
+def random_values(seed, size=2000):
+    rng = np.random.default_rng(seed)
+    magnitudes = 10.0 ** rng.uniform(-4, 16, size)
+    values = magnitudes * rng.choice([-1, 1], size)
+    # Values on a half-way point of the rounding
+    halves = rng.integers(-10**6, 10**6, size) / 8
+    return np.concatenate([values, halves])
+
+def reference(values, fmt):
+    return np.array([fmt(value) for value in values], dtype=object)
+
+@pytest.mark.parametrize("fmt", [format_int, format_float, format_perc, format_rev, format_perc_to_ratio])
+def test_edge_values_match_format_functions(fmt):
+    assert fmt in FUNCTION_FORMATS
+    values = np.array(EDGE_VALUES)
+    assert list(format_column(pd.Series(values), fmt)) == list(reference(values, fmt))
+
+@pytest.mark.parametrize("fmt", [format_int, format_float, format_perc, format_rev, format_perc_to_ratio])
+def test_random_values_match_format_functions(fmt):
+    values = random_values(0)
+    assert list(format_column(pd.Series(values), fmt)) == list(reference(values, fmt))
+
+def test_integer_column_matches_format_int():
+    values = pd.Series([0, -1, 999, 1000, -1234567, 10**15, -(10**17)])
+    assert list(format_column(values, format_int)) == list(reference(values, format_int))
@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+import libs.get_data as get_data
+
+QUERY_NAME = "q"
+DAYS = 40
+
+# `update_local_data` reads ../sql/<name>.sql and writes ./data/, relative to the test's directory
+@pytest.fixture
+def test_dir(tmp_path, monkeypatch):
+    (tmp_path / "sql").mkdir()
+    (tmp_path / "sql" / f"{QUERY_NAME}.sql").write_text("SELECT * FROM events WHERE event_date BETWEEN {{ @START_DATE }} AND {{ @END_DATE }}")
+    (tmp_path / "test").mkdir()
+    monkeypatch.chdir(tmp_path / "test")
+    return tmp_path / "test"
+
+# Two rows for every day up to yesterday, which is where `update_local_data` stops
+def build_events():
+    today = pd.Timestamp.today().normalize()
+    days = pd.date_range(today - pd.Timedelta(days=DAYS), today - pd.Timedelta(days=1))
+    return pd.DataFrame({"event_date": np.repeat(days, 2), "optimisation_variant": np.tile(["Control", "variation_1"], len(days)), "impressions": 1})
+
+# Records the shards it's asked for and fails every attempt at the ones covering `failing_day`
+def recording_runner(events, failing_day=None):
+    runner = get_data.frame_runner(events)
+    calls = []
+    def run(query, name, start_date, end_date):
+        calls.append((start_date, end_date))
+        if failing_day != None and start_date <= failing_day <= end_date:
+            raise ConnectionError("shard failed")
+        return runner(query, name, start_date, end_date)
+    return run, calls
+
+def load(storage):
+    if storage == "parquet":
+        return get_data.get_local_parquet_data(f"./data/{QUERY_NAME}")
+    return get_data.get_local_data(f"./data/{QUERY_NAME}.csv")
+
+@pytest.mark.parametrize("storage", ["parquet", "csv"])
+def test_failed_shard_is_requeued(test_dir, storage):
+    events = build_events()
+    start_date = events.event_date.min().strftime("%Y-%m-%d")
+    failing_day = events.event_date.max() - pd.Timedelta(days=30)
+    output_path = f"./data/{QUERY_NAME}" + ("" if storage == "parquet" else ".csv")
+    pending_path = get_data.get_pending_path(output_path)
+
+    flaky, calls = recording_runner(events, failing_day)
+    with pytest.raises(RuntimeError):
+        get_data.update_local_data(QUERY_NAME, start_date, storage=storage, shard_days=1, runner=flaky, retries=2, max_workers=4)
+    assert len([call for call in calls if call[0] == failing_day]) == 3
+    with open(pending_path, "r") as file:
+        assert json.load(file) == [[f"{failing_day:%Y-%m-%d}", f"{failing_day:%Y-%m-%d}"]]
+    written = load(storage)
+    assert failing_day not in set(pd.to_datetime(written.event_date))
+    assert written.shape[0] == events.shape[0] - 2
+
+    runner, calls = recording_runner(events)
+    get_data.update_local_data(QUERY_NAME, start_date, storage=storage, shard_days=1, runner=runner)
+    assert calls == [(failing_day, failing_day)]
+    assert not (test_dir / pending_path).exists()
+    written = load(storage)
+    assert written.shape[0] == events.shape[0]
+    assert (pd.to_datetime(written.event_date).value_counts() == 2).all()
+
+    # Nothing is left to pull
+    runner, calls = recording_runner(events)
+    get_data.update_local_data(QUERY_NAME, start_date, storage=storage, shard_days=1, runner=runner)
+    assert calls == []
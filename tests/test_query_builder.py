@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+import libs.analysis as analysis
+import libs.get_data as get_data
+import libs.query_builder as query_builder
+
+START_DATE = "2026-09-03"
+END_DATE = "2026-09-10"
+METRICS = [
+    analysis.build_metric_object(0, "impressions", "Impressions", None),
+    analysis.build_metric_object(1, "add_to_carts", "Add to cart rate", "impressions"),
+    analysis.build_metric_object(2, "transaction_revenue", "Transaction Revenue", "add_to_carts"),
+    dict(analysis.build_metric_object(3, "users", "Users", None), expression="COUNT(DISTINCT user_id)"),
+]
+
+# Event-level rows spanning more days than the queried range
+def build_events(seed=0, rows=5000):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "event_date": rng.choice(pd.date_range("2026-09-01", "2026-09-14"), rows),
+        "optimisation_id": "pah001",
+        "optimisation_variant": rng.choice(["Control", "variation_1"], rows),
+        "device_category": rng.choice(["mobile", "desktop", "tablet"], rows),
+        "user_id": rng.integers(0, 800, rows),
+        "impressions": rng.integers(0, 3, rows),
+        "add_to_carts": rng.integers(0, 2, rows),
+        "transaction_revenue": rng.uniform(0, 50, rows).round(2),
+    })
+
+def test_generated_query_matches_pandas():
+    events = build_events()
+    keys = query_builder.DEFAULT_KEYS + ["device_category"]
+    query = query_builder.build_aggregate_query(METRICS, dimensions=["device_category"])
+    result = query_builder.run_local_query(get_data.process_query(query, START_DATE, END_DATE), events, START_DATE, END_DATE)
+
+    in_range = events[(events.event_date >= START_DATE) & (events.event_date <= END_DATE)]
+    expected = in_range.groupby(keys).agg(
+        impressions=("impressions", "sum"),
+        add_to_carts=("add_to_carts", "sum"),
+        transaction_revenue=("transaction_revenue", "sum"),
+        users=("user_id", "nunique"),
+    ).reset_index()
+
+    result = result.sort_values(keys).reset_index(drop=True)
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    assert list(result.columns) == list(expected.columns)
+    assert result["event_date"].min() == pd.Timestamp(START_DATE) and result["event_date"].max() == pd.Timestamp(END_DATE)
+    pd.testing.assert_frame_equal(result[keys], expected[keys])
+    for column in ["impressions", "add_to_carts", "users"]:
+        assert np.array_equal(result[column].to_numpy(), expected[column].to_numpy())
+    assert np.allclose(result["transaction_revenue"], expected["transaction_revenue"])
+
+def test_where_clause_filters_rows():
+    events = build_events(1)
+    query = query_builder.build_aggregate_query(METRICS[:2], where="device_category = 'mobile'")
+    result = query_builder.run_local_query(get_data.process_query(query, START_DATE, END_DATE), events, START_DATE, END_DATE)
+    in_range = events[(events.event_date >= START_DATE) & (events.event_date <= END_DATE) & (events.device_category == "mobile")]
+    assert result["impressions"].sum() == in_range["impressions"].sum()
+    assert result["add_to_carts"].sum() == in_range["add_to_carts"].sum()